@@ -16,13 +16,15 @@
 ##  You should have received a copy of the GNU Affero General Public License
 ##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, Response, abort, jsonify, request, render_template
 app = Flask(__name__)
 app.debug = True
 import helpers
 from elements import common_name, display_name
 from werkzeug import ImmutableDict
 import changemonger
+import metrics
+import json
 from inspect import getsource
 from pprint import pformat
 class FlaskWithHamlish(Flask):
@@ -86,8 +88,7 @@ def display_relation():
 def display_changeset():
     if request.args.has_key('id'):
         id = request.args['id']
-        cset = helpers.get_changeset_or_404(id)
-        sentence = changemonger.changeset_sentence(cset)
+        cset, sentence = helpers.get_changeset_summary_or_404(id)
         return render_template('changeset_details.haml',
                                changeset = cset,
                                sentence = sentence)
@@ -96,10 +97,12 @@ def display_changeset():
 
 @app.route('/features')
 def show_features():
+    # The database can be swapped by a reload, so use one throughout
+    db = changemonger.db
     return render_template('features.haml',
-                           simple = changemonger.db.simple,
-                           categories = changemonger.db.categories,
-                           magic = changemonger.db.magic)
+                           simple = db.simple,
+                           categories = db.categories,
+                           magic = db.magic)
 
 @app.route('/feature/<id>')
 def show_feature(id):
@@ -110,8 +113,14 @@ def show_feature(id):
 
 @app.route('/dbstats')
 def show_stats():
-    return jsonify(features=len(changemonger.db._features),
-                   categories=len(changemonger.db._categories))
+    db = changemonger.db
+    return jsonify(features=len(db.simple),
+                   categories=len(db.categories))
+
+@app.route('/metrics')
+def show_metrics():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/features/node/<id>')
 def api_node(id):
@@ -139,10 +148,40 @@ def api_relation(id):
 
 @app.route('/api/changeset/<id>')
 def show_changeset(id):
-    cset = helpers.get_changeset_or_404(id)
-    sentence = changemonger.changeset_sentence(cset)
+    cset, sentence = helpers.get_changeset_summary_or_404(id)
     return jsonify(sentence=sentence)
 
+def ndjson(results):
+    "Stream results back as newline delimited JSON"
+    return Response((json.dumps(result) + '\n' for result in results),
+                    mimetype='application/x-ndjson')
+
+@app.route('/api/features/<type>s', methods=['GET', 'POST'])
+def api_bulk_features(type):
+    if type not in ('node', 'way', 'relation'):
+        abort(404)
+    ids = helpers.get_ids_or_400(versioned = True)
+    def results():
+        for id, ele, error in changemonger.iter_elements(type, ids):
+            if error:
+                yield {'type': type, 'id': id, 'error': error}
+            else:
+                features = changemonger.features(ele)
+                yield {'type': type, 'id': id, 'cn': common_name(ele),
+                       'features': [f.name for f in features]}
+    return ndjson(results())
+
+@app.route('/api/changesets', methods=['GET', 'POST'])
+def api_bulk_changesets():
+    ids = helpers.get_ids_or_400()
+    def results():
+        for id, summary, error in changemonger.iter_changeset_summaries(ids):
+            if error:
+                yield {'changeset': id, 'error': error}
+            else:
+                yield {'changeset': id, 'sentence': summary[1]}
+    return ndjson(results())
+
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(
         description="Sample changemonger web application")
@@ -152,5 +191,37 @@ if __name__ == '__main__':
                            default='127.0.0.1', help = 'Set the IP to bind to')
     argparser.add_argument('-D', '--debug', action='store_true', default=False,
                            dest='debug', help = 'Set debug on')
+    argparser.add_argument('-s', '--store', action='store', default=None,
+                           dest='store',
+                           help = 'Look parents up in a local element store')
+    argparser.add_argument('-F', '--feature-store', action='store',
+                           default=None, dest='feature_store',
+                           help = 'Read features from a feature store')
+    argparser.add_argument('-a', '--api', action='store', default=None,
+                           dest='api', help = 'The OSM API to use, such as '
+                           'http://api.openstreetmap.org/api/0.6')
+    argparser.add_argument('-r', '--rate', action='store', type=float,
+                           default=None, dest='rate',
+                           help = 'Most OSM API requests to make per second')
+    argparser.add_argument('-w', '--watch', action='store_true',
+                           default=False, dest='watch',
+                           help = 'Reload features when their files change')
     args = argparser.parse_args()
-    app.run(port=args.port, host=args.ipaddr, debug=args.debug)
+    if args.api or args.rate:
+        import osmapi
+        options = {}
+        if args.api:
+            options['endpoint'] = args.api
+        if args.rate:
+            options['rate'] = args.rate
+        osmapi.configure(**options)
+    if args.feature_store:
+        import featurestore
+        changemonger.db = featurestore.StoredFeatureDB(args.feature_store)
+    if args.watch:
+        changemonger.watch_features()
+    if args.store:
+        import elements, localstore
+        elements.local_store = localstore.ElementStore(args.store)
+    app.run(port=args.port, host=args.ipaddr, debug=args.debug,
+            threaded=True)
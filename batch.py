@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Summarizes many changesets at once across a pool of processes,
+writing one JSON line per changeset"""
+
+import os
+import sys
+import json
+import logging
+import multiprocessing
+
+# Importing changemonger loads the feature database. Workers inherit
+# it from this process, so it's loaded once and reused for every
+# changeset rather than once per job
+import changemonger
+import osmapi
+import parser
+import replication
+from localstore import open_file
+
+def parse_ids(specs):
+    """Turn a list of ids, comma separated ids and ranges like
+    100-200 into a list of changeset ids"""
+    ids = []
+    for spec in specs:
+        for part in spec.split(','):
+            if not part:
+                continue
+            if '-' in part:
+                first, last = part.split('-', 1)
+                ids.extend(str(i) for i in range(int(first), int(last) + 1))
+            else:
+                ids.append(str(int(part)))
+    return ids
+
+def change_files(directory):
+    """Return the saved osmChange files in a directory, named by
+    changeset id"""
+    files = []
+    for fname in sorted(os.listdir(directory)):
+        name = fname
+        for ext in ('.gz', '.bz2', '.osc', '.osm', '.xml'):
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+        if name != fname and name[0] != '.':
+            files.append((name, os.path.join(directory, fname)))
+    return files
+
+def summarize_id(id):
+    "Fetch and summarize a changeset from the API"
+    cset, sentence = changemonger.changeset_summary(id)
+    return {'changeset': id,
+            'user': cset['user'],
+            'elements': len(cset['elements']),
+            'sentence': sentence}
+
+def summarize_file(id, fname, remote = False):
+    "Summarize a saved osmChange file"
+    fd = open_file(fname)
+    try:
+        eles = list(parser.iterparseChange(fd))
+    finally:
+        fd.close()
+    if not eles:
+        return {'changeset': id, 'elements': 0, 'sentence': None}
+    return replication.summarize(id, eles, remote)
+
+def _work(job):
+    "Run a single job in a worker, turning failures into results"
+    id, fname, remote = job
+    try:
+        if fname:
+            return summarize_file(id, fname, remote)
+        else:
+            return summarize_id(id)
+    except Exception, msg:
+        logging.exception("Couldn't summarize changeset %s" % id)
+        return {'changeset': id, 'error': str(msg)}
+
+def finished(fname):
+    """Return the changesets already summarized in an output file, so
+    an interrupted run can be resumed"""
+    done = set()
+    if os.path.exists(fname):
+        with open(fname) as fd:
+            for line in fd:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # Probably a line cut short by an interruption
+                    continue
+                if 'error' not in result:
+                    # Older outputs may have numeric ids
+                    done.add(str(result['changeset']))
+    return done
+
+def _init_worker(rate, burst):
+    "Give a worker its share of the OSM API rate limit"
+    osmapi.client.limiter = osmapi.TokenBucket(rate, burst)
+
+def run(jobs, output, processes = None, ordered = False, progress = None,
+        rate = None):
+    """Summarize jobs of (id, filename or None, remote) across a pool
+    of processes and write each result to output as it arrives.
+    Returns the number of failures. Every process has its own OSM API
+    client, so rate (requests per second, the client's rate if None)
+    is shared out between them.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    limiter = osmapi.client.limiter
+    if rate is None:
+        rate = limiter.rate
+    burst = limiter.burst * rate / limiter.rate
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (float(rate) / processes,
+                                 max(1, int(burst / processes))))
+    failed = 0
+    try:
+        if ordered:
+            results = pool.imap(_work, jobs)
+        else:
+            results = pool.imap_unordered(_work, jobs)
+        for n, result in enumerate(results):
+            if 'error' in result:
+                failed += 1
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            if progress:
+                progress.write("\r%d/%d done, %d failed" % (
+                    n + 1, len(jobs), failed))
+                progress.flush()
+    finally:
+        pool.close()
+        pool.join()
+    if progress:
+        progress.write("\n")
+    return failed
+
+if __name__ == '__main__':
+    import argparse
+    argparser = argparse.ArgumentParser(
+        description="Summarize many changesets in parallel")
+    argparser.add_argument('ids', nargs='*',
+                           help = 'Changeset ids or ranges such as 100-200')
+    argparser.add_argument('-d', '--directory', action='store',
+                           default=None, dest='directory',
+                           help = 'Summarize saved osmChange files instead')
+    argparser.add_argument('-o', '--output', action='store',
+                           default='summaries.jsonl', dest='output',
+                           help = 'File to append JSON lines to')
+    argparser.add_argument('-p', '--processes', action='store', type=int,
+                           default=None, dest='processes',
+                           help = 'Number of worker processes')
+    argparser.add_argument('--ordered', action='store_true', default=False,
+                           dest='ordered',
+                           help = 'Write results in input order')
+    argparser.add_argument('-r', '--remote', action='store_true',
+                           default=False, dest='remote',
+                           help = 'Look up parents for saved files')
+    argparser.add_argument('--rate', action='store', type=float,
+                           default=None, dest='rate',
+                           help = 'Most OSM API requests to make per second, '
+                           'across all the worker processes')
+    argparser.add_argument('-q', '--quiet', action='store_true',
+                           default=False, dest='quiet',
+                           help = 'Don\'t report progress')
+    args = argparser.parse_args()
+    done = finished(args.output)
+    if args.directory:
+        jobs = [(id, fname, args.remote)
+                for id, fname in change_files(args.directory)
+                if id not in done]
+    else:
+        jobs = [(id, None, args.remote) for id in parse_ids(args.ids)
+                if id not in done]
+    with open(args.output, 'a') as output:
+        failed = run(jobs, output, args.processes, args.ordered,
+                     None if args.quiet else sys.stderr, args.rate)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmarks for the stages of summarizing a changeset, run
+against synthetic osmChange documents with the OSM API stubbed out so
+results are deterministic and need no network"""
+
+import time
+import random
+import argparse
+import resource
+import logging
+from StringIO import StringIO
+from collections import OrderedDict
+from contextlib import contextmanager
+from xml.sax.saxutils import quoteattr
+
+import osmapi
+import parser
+import elements
+import changemonger
+import metrics
+
+# (tags, weight) pairs. An empty tag list makes untagged elements
+default_mix = [([], 10),
+               (['highway=residential'], 5),
+               (['building=yes'], 5),
+               (['amenity=cafe', 'name=Cafe'], 1),
+               (['amenity=parking', 'parking=surface'], 1),
+               (['shop=bakery'], 1)]
+
+def parse_mix(spec):
+    """Parse a tag mix like 'highway=residential:5,amenity=cafe+name=Cafe:1,:10'
+    where + joins tags and an empty tag list means untagged. Raises
+    argparse.ArgumentTypeError if it's malformed, so it can be given
+    to argparse as a type."""
+    mix = []
+    for part in spec.split(','):
+        if ':' not in part:
+            raise argparse.ArgumentTypeError(
+                "%r has no weight, expected tags:weight" % part)
+        tags, weight = part.rsplit(':', 1)
+        try:
+            weight = int(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "%r has a weight which isn't a whole number" % part)
+        tags = [t for t in tags.split('+') if t]
+        for tag in tags:
+            if '=' not in tag:
+                raise argparse.ArgumentTypeError(
+                    "%r isn't a key=value tag" % tag)
+        mix.append((tags, weight))
+    return mix
+
+def _pick(rand, mix):
+    "Pick a tag list from a weighted mix"
+    n = rand.uniform(0, sum(weight for tags, weight in mix))
+    for tags, weight in mix:
+        n -= weight
+        if n <= 0:
+            return tags
+    return mix[-1][0]
+
+def _tag_xml(tags):
+    return ''.join('<tag k=%s v=%s/>' % tuple(quoteattr(s) for s in
+                                               tag.split('=', 1))
+                   for tag in tags)
+
+def synthetic_change(nodes = 1000, ways = 100, relations = 10,
+                     mix = default_mix, seed = 0):
+    """Return a synthetic osmChange document. Way nodes are taken from
+    the document's own nodes, about a third of the ways are closed and
+    relations have ways as members"""
+    rand = random.Random(seed)
+    attrs = 'version="1" changeset="1" user="bench" uid="1"'
+    out = ['<osmChange version="0.6"><create>']
+    for id in range(1, nodes + 1):
+        out.append('<node id="%d" %s lat="0" lon="0">%s</node>' % (
+            id, attrs, _tag_xml(_pick(rand, mix))))
+    for id in range(1, ways + 1):
+        nd = [rand.randint(1, nodes) for i in range(rand.randint(2, 10))]
+        if rand.random() < 0.3:
+            nd.append(nd[0])
+        out.append('<way id="%d" %s>%s%s</way>' % (
+            id, attrs, ''.join('<nd ref="%d"/>' % ref for ref in nd),
+            _tag_xml(_pick(rand, mix))))
+    for id in range(1, relations + 1):
+        members = [rand.randint(1, ways) for i in range(rand.randint(1, 5))]
+        out.append('<relation id="%d" %s>%s%s</relation>' % (
+            id, attrs, ''.join('<member type="way" ref="%d" role=""/>' % ref
+                               for ref in members),
+            _tag_xml(['type=multipolygon'])))
+    out.append('</create></osmChange>')
+    return ''.join(out)
+
+def stub_osmapi(doc, parents = 0.1, open = False):
+    """Replace the OSM API calls with deterministic local answers. A
+    fraction of the nodes asked about get a remote parent way"""
+    def getChangeset(id):
+        return (u'<osm><changeset id="%s" user="bench" uid="1" '
+                u'open="%s"></changeset></osm>' % (
+                    id, 'true' if open else 'false'))
+    def getChangeStream(id, closed = False):
+        return StringIO(doc)
+    def getWaysforNode(id):
+        if random.Random(int(id)).random() < parents:
+            return (u'<osm><way id="%d" version="1"><nd ref="%s"/>'
+                    u'<tag k="highway" v="service"/></way></osm>' % (
+                        10000000 + int(id), id))
+        return u'<osm></osm>'
+    def getRelationsforElement(type, id):
+        return u'<osm></osm>'
+    osmapi.getChangeset = getChangeset
+    osmapi.getChangeStream = getChangeStream
+    osmapi.getWaysforNode = getWaysforNode
+    osmapi.getRelationsforElement = getRelationsforElement
+
+def _rss():
+    """The resident memory of the process in kilobytes. Without /proc
+    this falls back to the peak, which only shows stages that raise it"""
+    try:
+        with open('/proc/self/statm') as fd:
+            pages = int(fd.read().split()[1])
+        return pages * resource.getpagesize() / 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Stages:
+    """Records the wall clock time and the change in resident memory
+    of each stage changemonger times for its metrics, while it's
+    installed in place of metrics.stage_seconds.time"""
+    def __init__(self):
+        self.results = OrderedDict()
+        self._time = None
+
+    @contextmanager
+    def time(self, stage):
+        start = time.time()
+        rss = _rss()
+        try:
+            yield
+        finally:
+            seconds, growth = self.results.get(stage, (0, 0))
+            self.results[stage] = (seconds + time.time() - start,
+                                   growth + _rss() - rss)
+
+    def __enter__(self):
+        self._time = metrics.stage_seconds.time
+        metrics.stage_seconds.time = self.time
+        return self
+
+    def __exit__(self, *exc):
+        metrics.stage_seconds.time = self._time
+
+def run(id = 1, state = None):
+    """Summarize a changeset once the way changemonger does and return
+    a list of (stage, seconds, rss growth in kilobytes). Given an
+    OpenChangeset, the changeset is summarized incrementally."""
+    with Stages() as stages:
+        if state is None:
+            cset = changemonger.changeset(id)
+            changemonger.changeset_sentence(cset)
+        else:
+            cset, matches = state.update()
+            changemonger.changeset_sentence(cset, matches)
+    return [(name, seconds, rss)
+            for name, (seconds, rss) in stages.results.items()]
+
+def report(runs):
+    """Print the best time, mean time and largest memory growth of
+    each stage"""
+    print "%-26s %10s %10s %14s" % ('stage', 'best (s)', 'mean (s)',
+                                    'rss growth (MB)')
+    stages = OrderedDict()
+    for r in runs:
+        for name, seconds, rss in r:
+            stages.setdefault(name, []).append((seconds, rss))
+    for name, results in stages.items():
+        times = [seconds for seconds, rss in results]
+        print "%-26s %10.4f %10.4f %14.1f" % (
+            name, min(times), sum(times) / len(times),
+            max(rss for seconds, rss in results) / 1024.0)
+    totals = [sum(stage[1] for stage in r) for r in runs]
+    print "%-26s %10.4f %10.4f" % ('total', min(totals),
+                                   sum(totals) / len(totals))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Benchmark the changeset summary pipeline")
+    argparser.add_argument('-n', '--nodes', action='store', type=int,
+                           default=5000, dest='nodes')
+    argparser.add_argument('-w', '--ways', action='store', type=int,
+                           default=500, dest='ways')
+    argparser.add_argument('-r', '--relations', action='store', type=int,
+                           default=20, dest='relations')
+    argparser.add_argument('-m', '--mix', action='store', default=None,
+                           type=parse_mix, dest='mix',
+                           help = 'Tag mix, eg highway=residential:5,:10')
+    argparser.add_argument('-p', '--parents', action='store', type=float,
+                           default=0.1, dest='parents',
+                           help = 'Fraction of nodes with a remote parent way')
+    argparser.add_argument('--repeat', action='store', type=int, default=3,
+                           dest='repeat')
+    argparser.add_argument('-o', '--open', action='store_true',
+                           default=False, dest='open',
+                           help = 'Poll an open changeset incrementally')
+    argparser.add_argument('--seed', action='store', type=int, default=0,
+                           dest='seed')
+    args = argparser.parse_args()
+    logging.disable(logging.CRITICAL)
+    mix = args.mix or default_mix
+    doc = synthetic_change(args.nodes, args.ways, args.relations, mix,
+                           args.seed)
+    stub_osmapi(doc, args.parents, args.open)
+    if args.open:
+        # The first run follows the changeset and the rest poll it again
+        state = changemonger.OpenChangeset(1)
+        report([run(state = state) for i in range(args.repeat)])
+    else:
+        report([run() for i in range(args.repeat)])
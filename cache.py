@@ -0,0 +1,315 @@
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A two tier cache: a small in-process LRU in front of a directory
+of files on disk. Entries either live forever or expire after a ttl.
+"""
+
+import os
+import time
+import hashlib
+import tempfile
+import logging
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+class Cache:
+    """An LRU cache backed by files on disk"""
+    def __init__(self, directory = 'osm_cache', size = 1024,
+                 max_bytes = 512 * 1024 * 1024, prune_interval = 300,
+                 weigh = None, max_weight = None):
+        """Initialize the cache. size is the number of entries kept in
+        memory and max_bytes bounds the files kept on disk, which are
+        pruned in the background at most every prune_interval seconds.
+        Given a function weigh which estimates the size of a value, the
+        entries kept in memory weigh no more than max_weight between
+        them, and heavier values are only kept on disk.
+        """
+        self.directory = os.path.abspath(directory)
+        self.size = size
+        self.weigh = weigh
+        self.max_weight = max_weight
+        self._weight = 0
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._pruned = 0
+        self._pruning = False
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _path(self, key):
+        "The file on disk for a key"
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def _remember(self, key, expires, value):
+        "Put an entry at the front of the in-memory tier"
+        weight = 0
+        if self.weigh is not None:
+            weight = self.weigh(value)
+        with self._lock:
+            old = self._lru.pop(key, None)
+            if old:
+                self._weight -= old[2]
+            if self.max_weight is not None and weight > self.max_weight:
+                return
+            self._lru[key] = (expires, value, weight)
+            self._weight += weight
+            while len(self._lru) > self.size or (
+                self.max_weight is not None
+                and self._weight > self.max_weight):
+                self._weight -= self._lru.popitem(last = False)[1][2]
+
+    def _open(self, key):
+        """Open the file for a key, returning its expiry and a file
+        positioned at the start of the data, or (None, None)
+        """
+        path = self._path(key)
+        try:
+            fd = open(path, 'rb')
+        except IOError:
+            return None, None
+        expires = self._expiry(fd)
+        if expires is False or (expires is not None
+                                and expires <= time.time()):
+            fd.close()
+            self._remove(path)
+            return None, None
+        # Keep recently used files from being pruned. Another process
+        # sharing the directory may have pruned it already, but the
+        # open file can still be read
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return expires, fd
+
+    def _expiry(self, fd):
+        """Read the header of a cache file, returning its expiry, None
+        if it never expires or False if the header is damaged"""
+        header = fd.readline().strip()
+        if header == '-':
+            return None
+        try:
+            return float(header)
+        except ValueError:
+            return False
+
+    def _remove(self, path):
+        "Remove a file, ignoring files that have already gone"
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get(self, key):
+        "Return the text stored for a key, or None"
+        return self._get(key, lambda data: data.decode('utf-8'))
+
+    def get_object(self, key):
+        "Return the object stored for a key, or None"
+        return self._get(key, pickle.loads)
+
+    def _get(self, key, load):
+        "Look a key up in memory, then on disk, loading data from disk"
+        now = time.time()
+        with self._lock:
+            entry = self._lru.pop(key, None)
+            if entry and (entry[0] is None or entry[0] > now):
+                self._lru[key] = entry
+                self.hits += 1
+                return entry[1]
+            elif entry:
+                self._weight -= entry[2]
+        expires, fd = self._open(key)
+        if fd is None:
+            self.misses += 1
+            return None
+        try:
+            value = load(fd.read())
+        finally:
+            fd.close()
+        self.hits += 1
+        self._remember(key, expires, value)
+        return value
+
+    def open(self, key):
+        """Return a file containing the data stored for a key, or
+        None. Useful for large entries which shouldn't be read into
+        memory at once
+        """
+        expires, fd = self._open(key)
+        if fd is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return fd
+
+    def set(self, key, value, ttl = None):
+        """Store text under a key for ttl seconds, or forever if ttl
+        is None
+        """
+        self._set(key, value, value.encode('utf-8'), ttl)
+
+    def set_object(self, key, value, ttl = None):
+        """Store a picklable object under a key for ttl seconds, or
+        forever if ttl is None
+        """
+        self._set(key, value, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                  ttl)
+
+    def _set(self, key, value, data, ttl):
+        "Write data to disk and remember the value in memory"
+        if ttl is not None and ttl <= 0:
+            return
+        writer = self.writer(key, ttl)
+        writer.write(data)
+        writer.commit()
+        if ttl is None:
+            self._remember(key, None, value)
+        else:
+            self._remember(key, time.time() + ttl, value)
+
+    def writer(self, key, ttl = None):
+        """Return a writer which stores data under a key on disk once
+        committed
+        """
+        return _Writer(self, key, ttl)
+
+    def tee(self, source, key, ttl = None):
+        """Wrap a file-like object so everything read from it is stored
+        under a key once the end is reached
+        """
+        return _TeeReader(source, self.writer(key, ttl))
+
+    def _written(self):
+        """Called after each write to the disk. Starts a prune in the
+        background if it's been long enough since the last one"""
+        now = time.time()
+        with self._lock:
+            if self._pruning or now - self._pruned < self.prune_interval:
+                return
+            self._pruning = True
+            self._pruned = now
+        thread = threading.Thread(target = self._prune_in_background)
+        thread.daemon = True
+        thread.start()
+
+    def _prune_in_background(self):
+        try:
+            self.prune()
+        except Exception:
+            logging.exception("Couldn't prune %s" % self.directory)
+        finally:
+            with self._lock:
+                self._pruning = False
+
+    def prune(self):
+        """Remove expired and abandoned files, then remove the least
+        recently used files until the disk tier fits in max_bytes.
+        Other threads and processes may be removing files from the
+        same directory, so files which vanish are skipped.
+        """
+        now = time.time()
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith('.tmp'):
+                # Partial writes from readers that never finished
+                if stat.st_mtime < now - 3600:
+                    self._remove(path)
+                continue
+            try:
+                with open(path, 'rb') as fd:
+                    expires = self._expiry(fd)
+            except IOError:
+                continue
+            if expires is False or (expires is not None and expires <= now):
+                self._remove(path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        files.sort()
+        while files and total > self.max_bytes:
+            mtime, size, path = files.pop(0)
+            self._remove(path)
+            total -= size
+
+class _Writer:
+    """Writes an entry to a temporary file and moves it into place on
+    commit, so readers never see partial entries
+    """
+    def __init__(self, cache, key, ttl):
+        self._cache = cache
+        self._path = cache._path(key)
+        fd, self._tmp = tempfile.mkstemp(prefix = '.tmp',
+                                         dir = cache.directory)
+        self._fd = os.fdopen(fd, 'wb')
+        if ttl is None:
+            self._fd.write('-\n')
+        else:
+            self._fd.write('%f\n' % (time.time() + ttl))
+
+    def write(self, data):
+        self._fd.write(data)
+
+    def commit(self):
+        "Move the entry into place"
+        self._fd.close()
+        os.rename(self._tmp, self._path)
+        self._cache._written()
+
+    def discard(self):
+        "Throw away the entry"
+        self._fd.close()
+        self._cache._remove(self._tmp)
+
+class _TeeReader:
+    """A file-like object which copies what's read into a cache writer
+    and commits it at the end of the data
+    """
+    def __init__(self, source, writer):
+        self._source = source
+        self._writer = writer
+        self._done = False
+
+    def read(self, size = -1):
+        data = self._source.read(size)
+        if not self._done:
+            if data:
+                self._writer.write(data)
+            if not data or size is None or size < 0:
+                self._writer.commit()
+                self._done = True
+        return data
+
+    def close(self):
+        if not self._done:
+            self._writer.discard()
+            self._done = True
+        if hasattr(self._source, 'close'):
+            self._source.close()
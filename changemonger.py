@@ -21,15 +21,126 @@ from features import FeatureDB
 import xml.etree.ElementTree as et
 import parser
 import os
+import sys
+import time
+import logging
+import inspect
+import threading
+from functools import wraps
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import elements
+import cache
+import metrics
 from sets import Set
 
 db = FeatureDB()
 
+action_hash = {'create': 'created',
+               'modify': 'modified',
+               'delete': 'deleted'}
+
+def _summary_weight(summary):
+    "Roughly how big a summary is, in elements"
+    cset = summary[0]
+    return len(cset['elements']) + sum(len(eles) for action, eles
+                                       in cset.get('actions', ()))
+
+# Finished summaries, so popular changesets aren't fetched and
+# processed again on every request. Changesets are held in memory up
+# to about summary_memory_elements elements between them, and bigger
+# ones are read back from disk.
+summary_memory_elements = 100000
+summaries = cache.Cache('summary_cache', size = 256,
+                        weigh = _summary_weight,
+                        max_weight = summary_memory_elements)
+# How long, in seconds, summaries of open changesets are kept for.
+# Closed changesets can't change, so their summaries are kept forever.
+open_summary_ttl = 60
+# How many changesets iter_changeset_summaries works on at once
+bulk_concurrency = 4
+# Whether open changesets are followed incrementally between polls,
+# and how many are followed at once
+incremental = True
+open_changeset_limit = 64
+
+def reload_features():
+    """Pick up changes to the features directory, returning whether
+    anything changed. The new database replaces the old one in a single
+    assignment, so callers which already hold the old one can finish
+    with it undisturbed."""
+    global db
+    if not db.changed():
+        return False
+    db = db.reload()
+    logging.info("Reloaded features")
+    return True
+
+def watch_features(interval = 2):
+    """Check the features directory for changes every interval seconds
+    in a background thread"""
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_features()
+            except Exception:
+                # A half written file will be fine on the next pass
+                logging.exception("Couldn't reload features")
+    thread = threading.Thread(target = watch)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+class _Flight:
+    """A computation which other callers can wait on"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+def coalesce(fn):
+    """Share a single call among concurrent callers asking for the
+    same thing, so a popular changeset is only fetched and summarized
+    once however many requests come in for it while it's being done.
+    Failures are passed on to every waiting caller. Calls are the same
+    if they give the same arguments once defaults are filled in, so
+    node(1) and node(1, None) share a call."""
+    names = inspect.getargspec(fn).args
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        callargs = inspect.getcallargs(fn, *args, **kwargs)
+        key = (fn.__name__,) + tuple(str(callargs[name]) for name in names)
+        with _flights_lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
+        try:
+            flight.result = fn(*args, **kwargs)
+        except:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with _flights_lock:
+                del _flights[key]
+            flight.done.set()
+        return flight.result
+    return wrapper
+
 def features(element):
     """Takes a node element and returns the features it matches"""
     return db.matchAllSolo(element)
 
+@coalesce
 def node(id, version = None):
     """Gets a node from the OSM API and returns it as a complete element"""
     data = osmapi.getNode(id, version)
@@ -37,6 +148,7 @@ def node(id, version = None):
     root = xml.find('node')
     return parser.parseNode(root)
 
+@coalesce
 def way(id, version = None):
     """Gets a way from the OSM API and returns it as a complete element"""
     data = osmapi.getWay(id, version)
@@ -44,6 +156,7 @@ def way(id, version = None):
     root = xml.find('way')
     return parser.parseWay(root)
 
+@coalesce
 def relation(id, version = None):
     """Gets a relation from the OSM API and returns it as a complete element"""
     data = osmapi.getRelation(id, version)
@@ -51,43 +164,354 @@ def relation(id, version = None):
     root = xml.find('relation')
     return parser.parseRelation(root)
 
+def nodes(ids):
+    """Gets many nodes from the OSM API in as few requests as
+    possible. ids may contain (id, version) tuples. Nodes which can't
+    be fetched are left out."""
+    return [ele for id, ele, error in iter_elements('node', ids)
+            if ele is not None]
+
+def ways(ids):
+    """Gets many ways from the OSM API in as few requests as
+    possible. ids may contain (id, version) tuples. Ways which can't
+    be fetched are left out."""
+    return [ele for id, ele, error in iter_elements('way', ids)
+            if ele is not None]
+
+def relations(ids):
+    """Gets many relations from the OSM API in as few requests as
+    possible. ids may contain (id, version) tuples. Relations which
+    can't be fetched are left out."""
+    return [ele for id, ele, error in iter_elements('relation', ids)
+            if ele is not None]
+
+_parsers = {'node': parser.parseNode,
+            'way': parser.parseWay,
+            'relation': parser.parseRelation}
+
+def iter_elements(type, ids):
+    """Gets many elements of one type from the OSM API in as few
+    requests as possible, yielding (id, element, error) for each id as
+    its request completes. Elements which can't be fetched have an
+    error message instead of an element."""
+    parse = _parsers[type]
+    unique = []
+    seen = set()
+    for id in ids:
+        id = osmapi.idString(id)
+        if id not in seen:
+            seen.add(id)
+            unique.append(id)
+    for chunk, data, error in osmapi.iterMany(type, unique):
+        if data is not None:
+            try:
+                xml = et.XML(data.encode('utf-8'))
+                eles = {}
+                for root in xml.findall(type):
+                    # Ids may have asked for a version, as in 12v3
+                    ele = parse(root)
+                    eles[str(root.get('id'))] = ele
+                    eles['%sv%s' % (root.get('id'), root.get('version'))] = ele
+            except Exception, msg:
+                logging.exception("Couldn't parse %ss %s" % (
+                    type, ','.join(chunk)))
+                error = str(msg)
+        for id in chunk:
+            if error:
+                yield id, None, error
+            elif eles.has_key(id):
+                yield id, eles[id], None
+            else:
+                yield id, None, "Not found"
+
+def iter_changeset_summaries(ids, concurrency = None):
+    """Summarize many changesets at once, yielding (id, summary,
+    error) for each as it's finished"""
+    def work(id):
+        try:
+            return id, changeset_summary(id), None
+        except Exception, msg:
+            logging.exception("Couldn't summarize changeset %s" % id)
+            return id, None, str(msg)
+    pool = ThreadPool(concurrency or bulk_concurrency)
+    try:
+        for result in pool.imap_unordered(work, ids):
+            yield result
+    finally:
+        pool.terminate()
+
+def _changeset_metadata(id):
+    "Gets the metadata of a changeset from the OSM API"
+    with metrics.stage_seconds.time(stage = 'metadata'):
+        data = osmapi.getChangeset(id)
+        xml = et.XML(data.encode('utf-8'))
+        root = xml.find('changeset')
+        return parser.parseChangeset(root)
+
 def changeset(id):
     """Gets a changeset from the OSM API and returns it in a complete
     form ready to use
 
     """
     # First get the changeset metadata
-    data = osmapi.getChangeset(id)
-    xml = et.XML(data.encode('utf-8'))
-    root = xml.find('changeset')
-    changeset = parser.parseChangeset(root)
-    # Now get the OSM change for it
-    data = osmapi.getChange(id)
-    xml = et.XML(data.encode('utf-8'))
-    change = parser.parseChange(xml)
-    changeset['actions'] = change
-    # Now collect all the objects in this changeset for processing
+    changeset = _changeset_metadata(id)
+    # Now stream the OSM change for it, grouping the elements by
+    # action as they arrive
+    change = []
     eles = []
-    for i in changeset['actions']:
-        eles.extend(i[1])
+    closed = changeset.get('open') == 'false'
+    with metrics.stage_seconds.time(stage = 'download and parse'):
+        stream = osmapi.getChangeStream(id, closed)
+        for ele in parser.iterparseChange(stream):
+            if not change or change[-1][0] != ele['_action']:
+                change.append((ele['_action'], []))
+            change[-1][1].append(ele)
+            eles.append(ele)
+    changeset['actions'] = change
     # Add changeset tags to objects
     for ele in eles:
         ele['_changeset_tags'] = changeset['tags']
+    changeset['elements'] = link(eles)
+    return changeset
+
+def link(eles, remote = True):
+    """Takes the elements of a changeset, links them to each other
+    and (optionally) to their remote parents, and returns the
+    elements worth describing in sorted order"""
     # Make internal references based on info we already have
-    elements.add_local_way_references(eles)
-    elements.add_local_relation_references(eles)
+    with metrics.stage_seconds.time(stage = 'local linking'):
+        graph = elements.ElementGraph(eles)
+        elements.add_local_way_references(eles, graph)
+        elements.add_local_relation_references(eles, graph)
     # Now collect the rest from remote data
-    elements.add_remote_ways(eles)
-    elements.add_remote_relations(eles)
-    # Remove tagless items we have parent objects for
-    eles = elements.remove_unnecessary_items(eles)
-    # Sort elements
-    eles = elements.sort_elements(eles)
-    changeset['elements'] = eles
-    return changeset
+    if remote:
+        with metrics.stage_seconds.time(stage = 'remote enrichment'):
+            elements.add_remote_ways(eles, graph)
+            elements.add_remote_relations(eles, graph)
+    with metrics.stage_seconds.time(stage = 'cleanup'):
+        # Remove tagless items we have parent objects for
+        eles = elements.remove_unnecessary_items(eles)
+        # Sort elements
+        return elements.sort_elements(eles)
+
+class OpenChangeset:
+    """Follows a changeset which is still open. Each update downloads
+    the osmChange again, but only elements which weren't in it before
+    are linked and matched, and parents fetched for earlier elements
+    are remembered, so polling a big open changeset costs about as
+    much as what changed since the last poll.
+
+    Only the relationships which decide the summary are kept up to
+    date. Elements record the ways and relations in the changeset
+    which use them, but not the parents fetched for them.
+    """
+    def __init__(self, id):
+        self.id = str(id)
+        self._elements = {}
+        self._graph = elements.ElementGraph()
+        self._size = 0
+        # Parents fetched for elements which had none in the changeset
+        self._parent_ways = {}
+        self._parent_relations = {}
+        # Features matched for each element, by id(), along with the
+        # database they came from
+        self._features = {}
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _key(self, ele):
+        return (ele['type'], ele['id'], ele.get('version'), ele['_action'])
+
+    def _read(self, changeset):
+        """Download the changeset and return its elements in order,
+        with the ones seen before replaced by their earlier copies,
+        and the new ones"""
+        eles = []
+        new = []
+        with metrics.stage_seconds.time(stage = 'download and parse'):
+            stream = osmapi.getChangeStream(self.id)
+            for ele in parser.iterparseChange(stream):
+                key = self._key(ele)
+                if self._elements.has_key(key):
+                    ele = self._elements[key]
+                else:
+                    self._elements[key] = ele
+                    new.append(ele)
+                ele['_changeset_tags'] = changeset['tags']
+                eles.append(ele)
+        return eles, new
+
+    def _link(self, eles, new):
+        """Add new elements to the graph and update the local links of
+        the elements they touch"""
+        positions = dict((id(ele), n) for n, ele in enumerate(eles))
+        # Elements don't leave a changeset, but if they ever do the
+        # graph starts again
+        rebuild = len(eles) - len(new) != self._size
+        self._size = len(eles)
+        for ele in new:
+            # The graph keeps versions in changeset order, which only
+            # adding to the end of it keeps
+            for old in self._graph.get_all(ele['type'], ele['id']):
+                if positions.get(id(old), -1) > positions[id(ele)]:
+                    rebuild = True
+        if rebuild:
+            self._graph = elements.ElementGraph(eles)
+            touched = eles
+        else:
+            touched = set()
+            for ele in new:
+                self._graph.add(ele)
+                touched.add((ele['type'], ele['id']))
+                if ele['type'] == 'way':
+                    touched.update(('node', nd) for nd in ele['nd'])
+                elif ele['type'] == 'relation':
+                    touched.update((m['type'], m['ref'])
+                                   for m in ele['members'])
+            touched = [ele for key in touched
+                       for ele in self._graph.get_all(*key)]
+        for ele in touched:
+            ways = []
+            if ele['type'] == 'node':
+                ways = [way['id'] for way in
+                        self._graph.ways_for_node(ele['id'])]
+            relations = [rel['id'] for rel in self._graph.relations_for_member(
+                ele['type'], ele['id'])]
+            for key, value in (('_ways', ways), ('_relations', relations)):
+                if value:
+                    ele[key] = value
+                elif ele.has_key(key):
+                    del ele[key]
+
+    def _parents(self, eles):
+        """Return the parents which elements.add_remote_ways and
+        add_remote_relations would add, fetching only the ones not
+        seen before. Like those, a parent links the first version of
+        each element it contains, which then needs no parents of its
+        own."""
+        graph = self._graph
+        linked = set()
+        added = elements.ElementGraph()
+        parents = []
+        def first(type, id):
+            return graph.get(type, id) or added.get(type, id)
+        with metrics.stage_seconds.time(stage = 'remote enrichment'):
+            for ele in eles:
+                if (ele['type'] != 'node' or ele['tags']
+                    or ele.get('_ways') or ele.get('_relations')
+                    or id(ele) in linked):
+                    continue
+                ways = self._parent_ways.get(ele['id'])
+                if ways is None:
+                    ways = elements._parent_ways(ele['id'])
+                    self._parent_ways[ele['id']] = ways
+                for way in ways:
+                    parents.append(way)
+                    added.add(way)
+                    for nd in set(way['nd']):
+                        node = first('node', nd)
+                        if node:
+                            linked.add(id(node))
+            for ele in eles + parents:
+                if (ele['tags'] or ele.get('_ways') or ele.get('_relations')
+                    or id(ele) in linked):
+                    continue
+                key = (ele['type'], ele['id'])
+                relations = self._parent_relations.get(key)
+                if relations is None:
+                    relations = elements._parent_relations(*key)
+                    self._parent_relations[key] = relations
+                for rel in relations:
+                    parents.append(rel)
+                    added.add(rel)
+                    for member in rel['members']:
+                        obj = first(member['type'], member['ref'])
+                        if obj:
+                            linked.add(id(obj))
+        return parents
+
+    def update(self):
+        """Bring the changeset up to date, returning the changeset and
+        the features of its elements, or None if it has closed"""
+        with self._lock:
+            return self._update()
+
+    def _update(self):
+        changeset = _changeset_metadata(self.id)
+        if changeset.get('open') == 'false':
+            return None
+        eles, new = self._read(changeset)
+        change = []
+        for ele in eles:
+            if not change or change[-1][0] != ele['_action']:
+                change.append((ele['_action'], []))
+            change[-1][1].append(ele)
+        changeset['actions'] = change
+        with metrics.stage_seconds.time(stage = 'local linking'):
+            self._link(eles, new)
+        parents = self._parents(eles)
+        with metrics.stage_seconds.time(stage = 'cleanup'):
+            eles = elements.sort_elements(
+                elements.remove_unnecessary_items(eles + parents))
+        changeset['elements'] = eles
+        # Only elements not matched before need matching, unless the
+        # features have been reloaded
+        if self._db is not db:
+            self._db = db
+            self._features = {}
+        with metrics.stage_seconds.time(stage = 'matching'):
+            unmatched = [ele for ele in eles
+                         if not self._features.has_key(id(ele))]
+            for ele, features in zip(unmatched, self._db.matchEach(unmatched)):
+                self._features[id(ele)] = features
+        return changeset, [self._features[id(ele)] for ele in eles]
+
+# Open changesets being followed, most recently used last
+_open_changesets = OrderedDict()
+_open_changesets_lock = threading.Lock()
+
+def _open_summary(id):
+    """Summarize a changeset incrementally if it's open, returning
+    None if it's closed"""
+    with _open_changesets_lock:
+        state = _open_changesets.pop(str(id), None)
+        if state is None:
+            state = OpenChangeset(id)
+        _open_changesets[str(id)] = state
+        while len(_open_changesets) > open_changeset_limit:
+            _open_changesets.popitem(last = False)
+    result = state.update()
+    if result is None:
+        with _open_changesets_lock:
+            _open_changesets.pop(str(id), None)
+        return None
+    cset, matches = result
+    return cset, changeset_sentence(cset, matches)
+
+@coalesce
+def changeset_summary(id):
+    """Returns a complete changeset and its sentence as a tuple,
+    reusing a stored result when there is one"""
+    # Sentences depend on the features, so a change to them makes
+    # every stored summary stale
+    key = 'changeset/%s/%s' % (str(id), db.version())
+    summary = summaries.get_object(key)
+    if summary is None:
+        if incremental:
+            summary = _open_summary(id)
+        if summary is None:
+            cset = changeset(id)
+            summary = (cset, changeset_sentence(cset))
+        cset = summary[0]
+        if cset.get('open') == 'false':
+            summaries.set_object(key, summary)
+        else:
+            summaries.set_object(key, summary, open_summary_ttl)
+    return summary
 
-def changeset_sentence(cset):
-    """Take a changeset object and return a sentence"""
+def changeset_sentence(cset, matches = None):
+    """Take a changeset object and return a sentence. The features of
+    its elements are matched unless they're given"""
     # Future versions will be able to handle multiple users
     #user = elements.get_user(cset)
     user = cset['user']
@@ -100,10 +524,15 @@ def changeset_sentence(cset):
         action = action_hash[actions.pop()]
     else:
         action = 'edited'
-    ele_features = zip(eles, db.matchEach(eles))
-    sorted_ef = elements.sort_by_num_features(ele_features)
-    grouped_features = elements.feature_grouper(sorted_ef)
-    sorted_features = elements.sort_grouped(grouped_features)
-    english_list =  elements.grouped_to_english(sorted_features)
+    if matches is None:
+        with metrics.stage_seconds.time(stage = 'matching'):
+            matches = db.matchEach(eles)
+    ele_features = zip(eles, matches)
+    with metrics.stage_seconds.time(stage = 'grouping'):
+        sorted_ef = elements.sort_by_num_features(ele_features)
+        grouped_features = elements.feature_grouper(sorted_ef)
+        sorted_features = elements.sort_grouped(grouped_features)
+    with metrics.stage_seconds.time(stage = 'rendering'):
+        english_list =  elements.grouped_to_english(sorted_features)
     return "%s %s %s" % (user, action, english_list)
 
@@ -15,32 +15,85 @@
 ##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """Functions related to working with elements and collections of elements"""
-import inflect
+import language
 import osmapi
 import xml.etree.ElementTree as et
 import parser
 import features
-p = inflect.engine()
 
 import logging
 from pprint import pformat
+from multiprocessing.pool import ThreadPool
 
 #logging.basicConfig(level=logging.DEBUG)
 
-def retrieve(coll, type, id, version = None):
-    for item in coll:
-        if type == item['type'] and id == item['id']:
-            if version:
-                if version == item['version']:
-                    return item
+# How many remote lookups add_remote_ways and add_remote_relations
+# may have in flight at once. 1 fetches them one at a time.
+remote_concurrency = 4
+
+# A localstore.ElementStore to look parent ways and relations up in
+# instead of the API, or None to use the API
+local_store = None
+
+class ElementGraph:
+    """Indexes a collection of elements by (type, id), with reverse
+    indexes from nodes to the ways that use them and from members to
+    the relations that contain them
+    """
+    def __init__(self, coll = ()):
+        """Build the graph from a collection of elements"""
+        # A collection can hold several versions of the same element,
+        # so each key maps to a list in collection order
+        self._elements = {}
+        self._node_ways = {}
+        self._member_relations = {}
+        for ele in coll:
+            self.add(ele)
+
+    def add(self, ele):
+        "Add an element to the graph and its reverse indexes"
+        self._elements.setdefault((ele['type'], ele['id']), []).append(ele)
+        if ele['type'] == 'way':
+            # Closed ways repeat their first node, but only count once
+            for nd in set(ele['nd']):
+                self._node_ways.setdefault(nd, []).append(ele)
+        elif ele['type'] == 'relation':
+            for member in ele['members']:
+                key = (member['type'], member['ref'])
+                self._member_relations.setdefault(key, []).append(ele)
+
+    def get(self, type, id, version = None):
+        "Return the first matching element, or None"
+        for ele in self._elements.get((type, id), ()):
+            if version is None or version == ele['version']:
+                return ele
+        return None
+
+    def get_all(self, type, id):
+        "Return every version of an element"
+        return self._elements.get((type, id), [])
+
+    def ways_for_node(self, id):
+        "Return the ways in the graph which reference a node"
+        return self._node_ways.get(id, [])
+
+    def relations_for_member(self, type, id):
+        "Return the relations in the graph which contain an element"
+        return self._member_relations.get((type, id), [])
+
+def retrieve(coll, type, id, version = None, graph = None):
+    """Find an element in a collection, optionally by version"""
+    if graph is None:
+        graph = ElementGraph(coll)
+    return graph.get(type, id, version)
 
 def common_name(ele):
     """Take an element and return its common name"""
     if ele['tags'].has_key('brand'):
-        a = p.a(ele['tags']['brand'])
+        a = language.a(ele['tags']['brand'])
         return a + " " + ele['tags']['brand']
     elif ele['tags'].has_key('operator'):
-        a = p.a(ele['tags']['operator'])
+        a = language.a(ele['tags']['operator'])
         return a + " " + ele['tags']['operator']
     elif ele['tags'].has_key('name'):
         return ele['tags']['name']
@@ -53,7 +106,7 @@ def display_name(ele, feature):
 
     """
     if not ele.get('tags') or not feature.named:
-        return u"%s" % (p.a(feature.name))
+        return u"%s" % (feature.indefinite)
     elif ( 'name' in ele['tags'].keys() or
          'brand' in ele['tags'].keys() or
          'operator' in ele['tags'].keys()):
@@ -73,29 +126,37 @@ def sort_by_num_features(coll):
     order of quantity of elements
 
     """
-    def sort_num_features(a, b):
-        return len(b[1]) - len(a[1])
-    return sorted(coll, cmp=sort_num_features)
+    return sorted(coll, key=lambda ef: -len(ef[1]))
 
 def feature_grouper(coll):
     """Takes in a collection of elements and features and groups them
     by feature in the supplied order
     """
-    # This function isn't very efficient and should likely be
-    # rewritten
+    # Index the positions of the elements matching each feature. Each
+    # group takes the first feature of the first element not yet
+    # grouped, along with every other ungrouped element matching it,
+    # so every index entry is looked at no more than once
+    index = {}
+    for n, (ele, features) in enumerate(coll):
+        for feature in features:
+            index.setdefault(feature, []).append(n)
     grouped = []
-    while coll:
-        feature = coll[0][1][0]
-        eles = [f[0] for f in coll if feature in f[1]]
+    done = [False] * len(coll)
+    for n, (ele, features) in enumerate(coll):
+        if done[n]:
+            continue
+        feature = features[0]
+        eles = []
+        for i in index.pop(feature):
+            if not done[i]:
+                done[i] = True
+                eles.append(coll[i][0])
         grouped.append( (eles, feature) )
-        coll = [f for f in coll if feature not in f[1]]
     return grouped
 
 def sort_grouped(coll):
     """Sort a grouped collection (from feature_grouper)"""
-    def sort_num_elements(a, b):
-        return len(b[0]) - len(a[0])
-    return sorted(coll, cmp=sort_num_elements)
+    return sorted(coll, key=lambda group: -len(group[0]))
 
 def grouped_to_english(coll):
     """Take a grouped collection (from feature_grouper) and return it
@@ -104,11 +165,11 @@ def grouped_to_english(coll):
     l = []
     for elements, feature in coll:
         if len(elements) > 1:
-            l.append("%s %s" % (p.number_to_words(len(elements)),
+            l.append("%s %s" % (language.number_to_words(len(elements)),
                                 feature.plural))
         else:            
             l.append(display_name(elements[0], feature))
-    return p.join(l)
+    return language.join(l)
 
 def sort_elements(coll):
     """Take a collection of elements and sort them in a way that's
@@ -150,49 +211,45 @@ def remove_unnecessary_items(coll):
             l.append(ele)
     return l
 
-def add_local_way_references(coll):
+def _add_way_id(node, way):
+    "Add a way reference to a node"
+    logging.debug("Adding way reference for way %s to node %s" % (
+        str(way['id']), str(node['id'])))
+    if node.has_key('_ways'):
+        node['_ways'].append(way['id'])
+    else:
+        node['_ways'] = [way['id']]
+
+def add_local_way_references(coll, graph = None):
     """Takes a collection of elements and adds way callbacks to the
     nodes
 
     """
     logging.debug("Adding local way references")
-    # This isn't the most efficient way to do this
-    nodes = [ele for ele in coll if ele['type'] == 'node']
-    ways = [ele for ele in coll if ele['type'] == 'way']
-    for way in ways:
-        nd = way['nd']
-        for node in [node for node in nodes if node['id'] in nd]:
-            logging.debug("Adding way reference for way %s to node %s" % (
-                str(way['id']), str(node['id'])))
-            if node.has_key('_ways'):
-                node['_ways'].append(way['id'])
-            else:
-                node['_ways'] = [way['id']]
+    if graph is None:
+        graph = ElementGraph(coll)
+    for node in coll:
+        if node['type'] != 'node':
+            continue
+        for way in graph.ways_for_node(node['id']):
+            _add_way_id(node, way)
 
-def add_way_reference(coll, way):
+def add_way_reference(coll, way, graph = None):
     "Adds way references for a specific way and a collection of element"
-    nodes = [ele for ele in coll if ele['type'] == 'node']
-    for nd in way['nd']:
-        node = retrieve(coll, 'node', nd)
+    if graph is None:
+        graph = ElementGraph(coll)
+    for nd in set(way['nd']):
+        node = graph.get('node', nd)
         if node:
-            logging.debug("Adding way reference for way %s to node %s" % (
-                str(way['id']), str(node['id'])))
-            if node.has_key('_ways'):
-                node['_ways'].append(way['id'])
-            else:
-                node['_ways'] = [way['id']]
+            _add_way_id(node, way)
 
-def add_relation_references(coll, relation):
+def add_relation_references(coll, relation, graph = None):
     "Add relation references for a specific relation and collection of elements"
+    if graph is None:
+        graph = ElementGraph(coll)
     members = relation['members']
     for member in members:
-        id = member['ref']
-        type = member['type']
-        obj = None
-        for element in coll:
-            if element['type'] == type and element['id'] == id:
-                obj = element
-                break
+        obj = graph.get(member['type'], member['ref'])
         if obj:
             logging.debug("Adding relation reference for relation %s to %s %s"
                           % (str(relation['id']), obj['type'], obj['id']))
@@ -202,33 +259,79 @@ def add_relation_references(coll, relation):
                 obj['_relations'] = [relation]
 
 
-def add_local_relation_references(coll):
+def add_local_relation_references(coll, graph = None):
     """Takes a collection of elements and makes connections between
     the elenments for relations as necessary
 
     """
     logging.debug("Adding local relation references")
-    # Same here about inefficiency
-    relations = [ele for ele in coll if ele['type'] == 'relation']
-    for rel in relations:
-        members = [ (i['type'], i['ref']) for i in rel['members']]
-        for member in members:
-            type = member[0]
-            id = member[1]
-            # We'll use a list comprehension here even though it
-            # should only return a single element
-            for ele in [e for e in coll if (e['type'] == type
-                                            and e['id'] == id)]:
-                logging.debug("Adding relation reference for relation %s to %s %s" % ( str(rel['id']), e['type'], str(e['id'])))
-                if ele.has_key('_relations'):
-                    ele['_relations'].append(rel['id'])
-                else:
-                    ele['_relations'] = [rel['id']]
-
-def add_remote_ways(coll):
+    if graph is None:
+        graph = ElementGraph(coll)
+    for ele in coll:
+        for rel in graph.relations_for_member(ele['type'], ele['id']):
+            logging.debug("Adding relation reference for relation %s to %s %s" % ( str(rel['id']), ele['type'], str(ele['id'])))
+            if ele.has_key('_relations'):
+                ele['_relations'].append(rel['id'])
+            else:
+                ele['_relations'] = [rel['id']]
+
+def _in_waves(coll, needed, fetch, merge, concurrency = None):
+    """Call fetch on each element of coll which still needs it and
+    merge the results in collection order. Up to concurrency lookups
+    are sent at once, a wave at a time. Elements which an earlier
+    wave's results linked are dropped before the next wave is sent,
+    so at most a wave more is fetched than a sequential run fetches.
+    """
+    if concurrency is None:
+        concurrency = remote_concurrency
+    concurrency = max(concurrency, 1)
+    pool = None
+    if concurrency > 1 and len(coll) > 1:
+        pool = ThreadPool(min(concurrency, len(coll)))
+    try:
+        n = 0
+        while n < len(coll):
+            wave = []
+            while n < len(coll) and len(wave) < concurrency:
+                if needed(coll[n]):
+                    wave.append(coll[n])
+                n += 1
+            if pool is not None and len(wave) > 1:
+                results = pool.map(fetch, wave)
+            else:
+                results = [fetch(ele) for ele in wave]
+            for ele, result in zip(wave, results):
+                # Earlier results in the wave can link later elements
+                if needed(ele):
+                    merge(ele, result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def _parent_ways(id):
+    "Return the ways which use a node, from the local store or the API"
+    if local_store is not None:
+        return local_store.ways_for_node(id)
+    data = osmapi.getWaysforNode(id)
+    xml = et.XML(data.encode('utf-8'))
+    return [parser.parseWay(way) for way in xml.findall('way')]
+
+def _parent_relations(type, id):
+    """Return the relations which contain an element, from the local
+    store or the API"""
+    if local_store is not None:
+        return local_store.relations_for_element(type, id)
+    data = osmapi.getRelationsforElement(type, id)
+    xml = et.XML(data.encode('utf-8'))
+    return [parser.parseRelation(rel) for rel in xml.findall('relation')]
+
+def add_remote_ways(coll, graph = None, concurrency = None):
     """Takes a collection of elements and adds way references for
     nodes if they don't have tags, or existing ways
     """
+    if graph is None:
+        graph = ElementGraph(coll)
     logging.debug("Adding remote way references. %d items in the collection."
                   % (len(coll)))
     nodes = [ele for ele in coll if (ele['type'] == 'node'
@@ -238,51 +341,49 @@ def add_remote_ways(coll):
     logging.debug("%d nodes to consider"
                   % (len(nodes)))
     logging.debug("Nodes: \n%s" % pformat(nodes))
-    for node in nodes:
-        if node['tags'] or node.get('_ways') or node.get('_relations'):
-            # It only needs to have one way for us to care. We're not
-            # looking at all the object relationships, just the first
-            # right now
-            continue
+    def needed(node):
+        # It only needs to have one way for us to care. We're not
+        # looking at all the object relationships, just the first
+        # right now
+        return not (node['tags'] or node.get('_ways')
+                    or node.get('_relations'))
+    def fetch(node):
         logging.debug("Node %s has no remote ways or relations. Retrieving." %
                       str(node['id']))
-        data = osmapi.getWaysforNode(node['id'])
-        xml = et.XML(data.encode('utf-8'))
-        ways = [parser.parseWay(way) for way in xml.findall('way')]
+        return _parent_ways(node['id'])
+    def merge(node, ways):
         for way in ways:
             logging.debug("Adding new way %s to collection" % way['id'])
             logging.debug(pformat(way))
             coll.append(way)
-            target_nodes = [retrieve(coll, 'node', node_id) for node_id in way['nd']]
-            target_nodes = [node for node in target_nodes if node]
-            logging.debug("%d nodes potentially effected" % len(target_nodes))
-            for node in target_nodes:
-                logging.debug("Adding way reference for way %s to node %s" % (
-                    str(way['id']), str(node['id'])))
-                if node.has_key('_ways'):
-                    node['_ways'].append(way['id'])
-                else:
-                    node['_ways'] = [way['id']]
+            graph.add(way)
+            add_way_reference(coll, way, graph)
             logging.debug("Done adding references for way %s" % way['id'])
+    if local_store is not None:
+        # Local lookups are quick and the store serializes them anyway
+        concurrency = 1
+    _in_waves(nodes, needed, fetch, merge, concurrency)
 
-def add_remote_relations(coll):
+def add_remote_relations(coll, graph = None, concurrency = None):
     """Takes an element of collections and fetches relations as necessary"""
     logging.debug("Adding remote relations")
+    if graph is None:
+        graph = ElementGraph(coll)
     elements = [ele for ele in coll if (not ele['tags']
+                                        and not ele.get('_ways')
                                         and not ele.has_key('_relations'))]
-    nodes = [ele for ele in coll if ele['type'] == 'node']
-    ways = [ele for ele in coll if ele['type'] == 'way']
-    relations = [ele for ele in coll if ele['type'] == 'relation']
-    for ele in elements:
+    def needed(ele):
         # We keep changing the elmements in place, so we must keep
         # checking them
-        if ele['tags'] or ele.get('_ways') or ele.get('_relations'):
-            continue
-        data = osmapi.getRelationsforElement(ele['type'], ele['id'])
-        xml = et.XML(data.encode('utf-8'))
-        rels = [parser.parseRelation(rel) for rel in xml.findall('relation')]
+        return not (ele['tags'] or ele.get('_ways') or ele.get('_relations'))
+    def fetch(ele):
+        return _parent_relations(ele['type'], ele['id'])
+    def merge(ele, rels):
         for rel in rels:
             logging.debug("Adding relation %s to collection" % str(rel['id']))
             coll.append(rel)
-            add_relation_references(coll, rel)
-
+            graph.add(rel)
+            add_relation_references(coll, rel, graph)
+    if local_store is not None:
+        concurrency = 1
+    _in_waves(elements, needed, fetch, merge, concurrency)
@@ -16,15 +16,33 @@
 
 """Contains functions related to Changemonger features for a yaml backend"""
 
-import inflect
 import yaml
 import os.path
 import imp
-
-inflection = inflect.engine()
+import copy
+import hashlib
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+import language
+
+# numpy makes matching big collections much faster, but isn't required
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class BaseFeature:
     """The base feature class"""
+    # What a magic feature's match depends on besides its types, so
+    # the database only asks about elements which could match. keys
+    # are tag keys of which an element needs at least one, tagged is
+    # whether it needs tags (True) or no tags (False) and closed is
+    # whether it has to be a closed way. None means either will do.
+    keys = None
+    tagged = None
+    closed = None
+
     def __init__(self, name):
         "Init the object"
         self.name = name
@@ -58,6 +76,25 @@ class BaseFeature:
         else:
             return True
 
+    def plausible(self, ele):
+        "Check that the element meets the feature's declared requirements"
+        if self.types and ele['type'] not in self.types:
+            return False
+        tags = ele['tags']
+        if self.keys is not None:
+            for key in self.keys:
+                if key in tags:
+                    break
+            else:
+                return False
+        if self.tagged is not None and bool(tags) != self.tagged:
+            return False
+        if self.closed is not None:
+            nd = ele.get('nd')
+            if bool(nd and nd[0] == nd[-1]) != self.closed:
+                return False
+        return True
+
     def category(self, cat):
         "Add a category to this feature"
         self.categories.append(cat)
@@ -70,7 +107,12 @@ class BaseFeature:
     @property
     def plural(self):
         "Returns the plural version of the feature's name"
-        return inflection.plural(self.name)
+        return language.plural(self.name)
+
+    @property
+    def indefinite(self):
+        "Returns the feature's name with its indefinite article"
+        return language.a(self.name)
 
     @property
     def precision(self):
@@ -131,36 +173,332 @@ def compare_precision(a, b):
     """Compare the precision of two features"""
     return b.precision - a.precision
 
+# Bump this whenever the layout of the snapshot changes
+SNAPSHOT_VERSION = 3
+
+# How many distinct match results each FeatureDB remembers
+match_cache_size = 4096
+# Collections at least this big are matched all at once with numpy
+batch_match_size = 1000
+
 class FeatureDB:
     """This is the abstraction against using the features"""
-    def __init__(self, directory = 'features'):
-        """Initialize feature database, use the argument as the directory"""
+    def __init__(self, directory = 'features', snapshot = True):
+        """Initialize feature database, use the argument as the
+        directory. Parsed features are kept in a snapshot next to the
+        directory, which is used until any of the yaml files change
+        """
         self._simple = []
         self._magic = []
         # We almost never iterate through categories, but we do call
-        # them by name a lot
-        self._categories = {}
+        # them by name a lot. Keeping them in order makes precision
+        # ties break the same way whether or not a snapshot is used
+        self._categories = OrderedDict()
         # The index contains unique IDs for features
         self._index = {}
+        # The tag index maps each key=value tag to the simple features
+        # that require it, so matching only has to look at candidates
+        self._tag_index = {}
+        # Simple features with no tags can't be found through the tag
+        # index and are always candidates
+        self._tagless = []
+        # Position of each feature in self.features, used to break
+        # precision ties the same way a linear scan would
+        self._ranks = {}
+        # The simple features loaded from each yaml file, so a reload
+        # only has to redo the files which changed
+        self._files = OrderedDict()
+        # Recent match results by element type, tags and magic matches
+        self._matches = OrderedDict()
+        self._matches_lock = threading.Lock()
+        # The arrays used by matchEach for big collections, made the
+        # first time they're needed
+        self._arrays = None
+        # Magic features by the tag keys they declare, and the ones
+        # without keys by element type
+        self._magic_keyed = {}
+        self._magic_unkeyed = {}
 
         # Now load the actual features
         if not os.path.isabs(directory):
             directory = os.path.abspath(directory)
         # We're going to just assume the directory exists for now
-        
+        self._directory = directory
+        self._snapshot = snapshot
+
+        snapshot_file = self._snapshot_file()
+        signature = self._signature(directory)
+        if not (snapshot and self._load_snapshot(snapshot_file, signature)):
+            self._load_yaml(directory)
+            self._precompute()
+            if snapshot:
+                self._save_snapshot(snapshot_file, signature)
+        self._source_signature = signature
+
+        self._magic_signature = self._magic_stat(directory)
+        if self._magic_signature:
+            self._load_magic_file(directory)
+        self._index_magic()
+
+        self._rank_features()
+
+    def _snapshot_file(self):
+        "The snapshot lives next to the features directory"
+        return self._directory.rstrip(os.sep) + '.snapshot'
+
+    def _magic_stat(self, directory):
+        "Identify the state of the magic file, or None if there isn't one"
+        try:
+            stat = os.stat(os.path.join(directory, 'magic.py'))
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def changed(self):
+        "Returns whether any of the files behind the database changed"
+        return (self._signature(self._directory) != self._source_signature
+                or self._magic_stat(self._directory) != self._magic_signature)
+
+    def version(self):
+        """A short string identifying the files behind the database,
+        which changes whenever they do"""
+        return hashlib.sha1(repr((self._source_signature,
+                                  self._magic_signature))).hexdigest()[:12]
+
+    def reload(self):
+        """Returns a new database with the changes to the features
+        directory applied. Only the files which changed are parsed and
+        only the features, categories and tag index entries they touch
+        are rebuilt. This database is left untouched, so anything still
+        using it keeps seeing a consistent set of features.
+        """
+        directory = self._directory
+        signature = self._signature(directory)
+        simple_files, category_files = self._yaml_sources(directory)
+        old_signature = dict((s[0], s[1:]) for s in self._source_signature)
+        new_signature = dict((s[0], s[1:]) for s in signature)
+        if [f for f in category_files
+            if old_signature.get(f) != new_signature[f]]:
+            # Categories files can touch anything, so start over
+            return FeatureDB(directory, self._snapshot)
+        declared = [item['name'] for fname in category_files
+                    for item in self._read_yaml(fname)]
+
+        changed = [f for f in simple_files
+                   if old_signature.get(f) != new_signature[f]]
+        removed = [f for f in self._files if f not in simple_files]
+        items = {}
+        for fname in changed:
+            items[fname] = self._read_yaml(fname)
+
+        # Features from changed or removed files go away, and the
+        # categories they were in, or are now in, have to be rebuilt
+        replaced = set()
+        dirty = set()
+        for fname in changed + removed:
+            for feature in self._files.get(fname, []):
+                replaced.add(feature)
+                dirty.update(c.name for c in feature.categories)
+        for fname in changed:
+            for item in items[fname]:
+                dirty.update(self._yaml_categories(item))
+        # Unchanged features in a rebuilt category are copied so the
+        # copy can point at the new category. Their other categories
+        # then need rebuilding too, until nothing more is touched
+        copied = set()
+        while True:
+            more = set()
+            for fname, features in self._files.items():
+                if fname in changed or fname in removed:
+                    continue
+                for feature in features:
+                    names = set(c.name for c in feature.categories)
+                    if feature not in copied and names & dirty:
+                        copied.add(feature)
+                        more.update(names - dirty)
+            if not more:
+                break
+            dirty.update(more)
+
+        new = copy.copy(self)
+        new._simple = []
+        new._magic = []
+        new._index = {}
+        new._matches = OrderedDict()
+        new._matches_lock = threading.Lock()
+        new._arrays = None
+        new._files = OrderedDict()
+        new._categories = OrderedDict()
+        for name, category in self._categories.items():
+            if name in dirty:
+                category = Category(name)
+            new._categories[name] = category
+            new._index[category.id] = category
+
+        added = []
+        for fname in simple_files:
+            if fname in items:
+                features = [new._yaml_item_to_feature(item)
+                            for item in items[fname]]
+                added.extend(features)
+            else:
+                features = []
+                for feature in self._files[fname]:
+                    if feature in copied:
+                        feature = copy.copy(feature)
+                        categories = feature.categories
+                        feature.categories = []
+                        for category in categories:
+                            category = new._categories[category.name]
+                            category.register(feature)
+                            feature.category(category)
+                        added.append(feature)
+                    features.append(feature)
+            new._files[fname] = features
+            new._simple.extend(features)
+        for feature in new._simple:
+            new._index[feature.id] = feature
+
+        # Only the tag index entries for features which changed are
+        # rebuilt. The rest are shared with this database, which is
+        # fine as entries are replaced rather than modified
+        gone = replaced | copied
+        tags = set()
+        for feature in list(gone) + added:
+            tags.update(feature.tags)
+        new._tag_index = dict(self._tag_index)
+        for tag in tags:
+            features = [f for f in self._tag_index.get(tag, [])
+                        if f not in gone]
+            if features:
+                new._tag_index[tag] = features
+            else:
+                new._tag_index.pop(tag, None)
+        new._tagless = [f for f in self._tagless if f not in gone]
+        for feature in added:
+            new._index_tags(feature)
+        # Categories which lost all their features go too, unless the
+        # categories file declares them
+        for name in dirty.difference(declared):
+            category = new._categories.get(name)
+            if category and not category.features:
+                del new._categories[name]
+                del new._index[category.id]
+        # Put the categories back in the order a full load would make,
+        # as it breaks precision ties
+        order = OrderedDict()
+        for feature in new._simple:
+            for category in feature.categories:
+                order[category.name] = category
+        for name in declared:
+            order.setdefault(name, new._categories[name])
+        new._categories = order
+        new._precompute()
+
+        new._magic_signature = new._magic_stat(directory)
+        if new._magic_signature != self._magic_signature:
+            if new._magic_signature:
+                new._load_magic_file(directory)
+        else:
+            for feature in self._magic:
+                new._magic.append(feature)
+                new._index[feature.id] = feature
+        new._index_magic()
+
+        new._source_signature = signature
+        if new._snapshot:
+            new._save_snapshot(new._snapshot_file(), signature)
+        new._rank_features()
+        return new
+    
+    def _yaml_sources(self, directory):
+        """Return the simple feature and category yaml files in the
+        order they're loaded"""
+        simple = []
+        categories = []
         if os.path.exists(os.path.join(directory, 'features.yaml')):
-            self._load_yaml_simple_features(
-                os.path.join(directory, 'simple.yaml'))
+            simple.append(os.path.join(directory, 'simple.yaml'))
         elif os.path.isdir(os.path.join(directory, 'simple')):
-            self._load_simple_directory(os.path.join(directory, 'simple'))
-        
+            simple.extend(self._simple_directory_files(
+                os.path.join(directory, 'simple')))
         if os.path.exists(os.path.join(directory, 'categories.yaml')):
-            self._load_yaml_categories(os.path.join(directory,
-                                                    'categories.yaml'))
+            categories.append(os.path.join(directory, 'categories.yaml'))
+        return simple, categories
+
+    def _load_yaml(self, directory):
+        """Load the simple features and categories from yaml"""
+        simple, categories = self._yaml_sources(directory)
+        for fname in simple:
+            self._load_yaml_simple_features(fname)
+        for fname in categories:
+            self._load_yaml_categories(fname)
+
+    def _signature(self, directory):
+        """Identify the current state of the yaml files by their names,
+        sizes and modification times"""
+        simple, categories = self._yaml_sources(directory)
+        signature = []
+        for fname in simple + categories:
+            try:
+                stat = os.stat(fname)
+                signature.append((fname, stat.st_size, stat.st_mtime))
+            except OSError:
+                signature.append((fname, None, None))
+        return signature
+
+    def _precompute(self):
+        """Work out everything that would otherwise be computed over and
+        over, so it can be stored in the snapshot"""
+        for feature in self._simple + self._categories.values():
+            # Instance attributes take precedence over the properties
+            if not feature.__dict__.has_key('plural'):
+                feature.plural = language.plural(feature.name)
+            feature.indefinite = language.a(feature.name)
+            if not feature.__dict__.has_key('precision'):
+                feature.precision = feature.__class__.precision.fget(feature)
+
+    def _load_snapshot(self, fname, signature):
+        """Load the simple features, categories and indexes from a
+        snapshot if it matches the yaml files, returning whether it
+        was used"""
+        try:
+            with open(fname, 'rb') as fd:
+                data = pickle.load(fd)
+        except (IOError, EOFError, pickle.UnpicklingError, ImportError,
+                AttributeError, ValueError):
+            return False
+        if (data.get('version') != SNAPSHOT_VERSION
+            or data.get('signature') != signature):
+            return False
+        self._simple = data['simple']
+        self._files = data['files']
+        self._categories = data['categories']
+        self._tag_index = data['tag_index']
+        self._tagless = data['tagless']
+        for feature in self._simple + self._categories.values():
+            self._index[feature.id] = feature
+        return True
+
+    def _save_snapshot(self, fname, signature):
+        """Write the simple features, categories and indexes out for the
+        next process to load"""
+        data = {'version': SNAPSHOT_VERSION,
+                'signature': signature,
+                'simple': self._simple,
+                'files': self._files,
+                'categories': self._categories,
+                'tag_index': self._tag_index,
+                'tagless': self._tagless}
+        tmp = '%s.%d.tmp' % (fname, os.getpid())
+        try:
+            with open(tmp, 'wb') as fd:
+                pickle.dump(data, fd, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, fname)
+        except (IOError, OSError):
+            # A read only checkout just doesn't get a snapshot
+            if os.path.exists(tmp):
+                os.remove(tmp)
 
-        if os.path.exists(os.path.join(directory, 'magic.py')):
-            self._load_magic_file(directory)
-    
     @property
     def all(self):
         """Return all objects in the database"""
@@ -179,14 +517,56 @@ class FeatureDB:
             if fp:
                 fp.close()
 
-    def _load_simple_directory(self, dirname):
-        """Load a directory of feature files"""
+    def _index_magic(self):
+        """Index the magic features by what they declare they need.
+        Entries keep the position of the feature, so matches can be
+        put back in order, and whether the index alone doesn't show
+        the feature is plausible"""
+        self._magic_keyed = {}
+        self._magic_unkeyed = {}
+        for type in ('node', 'way', 'relation'):
+            self._magic_unkeyed[type] = []
+        for n, feature in enumerate(self._magic):
+            if feature.keys:
+                for key in feature.keys:
+                    self._magic_keyed.setdefault(key, []).append(
+                        (n, (feature, True)))
+            else:
+                check = feature.tagged is not None or feature.closed is not None
+                for type, entries in self._magic_unkeyed.items():
+                    if not feature.types or type in feature.types:
+                        entries.append((n, (feature, check)))
+
+    def _magic_candidates(self, ele):
+        """Return the magic features which could match an element, in
+        the order they were loaded"""
+        entries = self._magic_unkeyed.get(ele['type'])
+        if entries is None:
+            # Not a type we know, so let every feature decide
+            return self._magic
+        keyed = self._magic_keyed
+        if keyed:
+            hits = [entry for key in ele['tags'] if key in keyed
+                    for entry in keyed[key]]
+            if hits:
+                entries = sorted(dict(entries + hits).items())
+        return [feature for n, (feature, check) in entries
+                if not check or feature.plausible(ele)]
+
+    def _simple_directory_files(self, dirname):
+        """Return the feature files in a directory"""
+        fnames = []
         for subdir, dirs, files in os.walk(dirname):
             for fname in files:
                 name, ext = os.path.splitext(fname)
                 if ext == '.yaml' and name[0] != '.':
-                    self._load_yaml_simple_features(
-                        os.path.join(dirname, fname))
+                    fnames.append(os.path.join(dirname, fname))
+        return fnames
+
+    def _load_simple_directory(self, dirname):
+        """Load a directory of feature files"""
+        for fname in self._simple_directory_files(dirname):
+            self._load_yaml_simple_features(fname)
 
     def _get_or_make_category(self, name):
         """Either retrieve a category or create one as necessary"""
@@ -242,24 +622,54 @@ class FeatureDB:
 
         return feature
 
+    def _yaml_categories(self, item):
+        """Return the category names a yaml item belongs to"""
+        categories = item.get('categories', [])
+        if isinstance(categories, basestring):
+            categories = categories.split(',')
+        return categories
+
+    def _read_yaml(self, fname):
+        """Return the items in a yaml file"""
+        with open(fname) as fd:
+            return yaml.safe_load(fd.read()) or []
+
     def _load_yaml_categories(self, fname):
         """Load a yaml file full of categories into the database"""
-        with open(fname) as fd:
-            data = fd.read()
-            yamldata = yaml.safe_load(data)
-            for item in yamldata:
-                category = self._get_or_make_category(item['name'])
+        for item in self._read_yaml(fname):
+            category = self._get_or_make_category(item['name'])
                 
     def _load_yaml_simple_features(self, fname):
         """Load a yaml of features file into the database"""
-        with open(fname) as fd:
-            data = fd.read()
-            yamldata = yaml.safe_load(data)
-            for item in yamldata:
-                # Make this a feature
-                feature = self._yaml_item_to_feature(item)
-                self._simple.append(feature)
-                self._index[feature.id] = feature
+        features = self._files.setdefault(fname, [])
+        for item in self._read_yaml(fname):
+            # Make this a feature
+            feature = self._yaml_item_to_feature(item)
+            features.append(feature)
+            self._simple.append(feature)
+            self._index[feature.id] = feature
+            self._index_tags(feature)
+
+    def _index_tags(self, feature):
+        """Add a simple feature to the tag index"""
+        if not feature.tags:
+            self._tagless.append(feature)
+        for tag in feature.tags:
+            self._tag_index.setdefault(tag, []).append(feature)
+
+    def _rank_features(self):
+        """Record the position of every feature for tie breaking"""
+        self._ranks = dict((feature, n) for n, feature
+                           in enumerate(self.features))
+
+    def _candidates(self, ele):
+        """Return the simple features which share at least one tag
+        with the element, plus the tagless ones
+        """
+        candidates = set(self._tagless)
+        for tag in ele['_tags']:
+            candidates.update(self._tag_index.get(tag, ()))
+        return candidates
     
     def add_index(self, feature):
         """Add feature id to internal id index"""
@@ -270,30 +680,139 @@ class FeatureDB:
 
     def matchBestSolo(self, ele):
         """Returns the best matching feature for an element"""
-        # This function is not optimized in any way. Ideally it should
-        # run in mongodb or maybe even some other way, but it's quick
-        # and dirty and it works.
-        match = None
-        match_val = -10
-        for feature in self.all:
-            if feature.precision > match_val and feature.match(ele):
-                match = feature
-                match_val = feature.precision
-        return match
+        # Ideally this should run in mongodb or maybe even some other
+        # way, but the tag index keeps it quick enough
+        matches = self.matchAllSolo(ele)
+        if matches and matches[0].precision > -10:
+            return matches[0]
+        return None
+
+    def _match_key(self, ele):
+        """Return the magic features an element matches and a key
+        which is the same for every element with the same matches"""
+        # Simple features and categories only look at the type and
+        # tags, but magic features can look at anything, so they're
+        # always checked and what they matched is part of the key
+        magic = [f for f in self._magic_candidates(ele) if f.match(ele)]
+        # Tags no simple feature uses, like names, make no difference.
+        # Features are old style instances, which are slow to compare,
+        # so the key holds their ids
+        index = self._tag_index
+        key = (ele['type'],
+               frozenset([tag for tag in ele['_tags'] if tag in index]),
+               tuple(f.id for f in magic))
+        return magic, key
 
     def matchAllSolo(self, ele):
         """Return all the matching features and categories for an
         element, sorted by precision
         """
-        features = []
-        for feature in self.features:
+        magic, key = self._match_key(ele)
+        with self._matches_lock:
+            matches = self._matches.pop(key, None)
+            if matches is not None:
+                self._matches[key] = matches
+                return list(matches)
+        features = set(magic)
+        for feature in self._candidates(ele):
             if feature.match(ele):
-                features.append(feature)
-        return(sorted(features, cmp=compare_precision))
+                features.add(feature)
+                # A category matches whenever one of its features does
+                features.update(feature.categories)
+        ranks = self._ranks
+        matches = sorted(features, key=lambda f: (-f.precision, ranks[f]))
+        with self._matches_lock:
+            self._matches[key] = tuple(matches)
+            while len(self._matches) > match_cache_size:
+                self._matches.popitem(last = False)
+        return matches
 
     def matchEach(self, coll):
         """Returns all the matches for all the elements in the collection"""
-        return [self.matchAllSolo(ele) for ele in coll]
+        if numpy is None or len(coll) < batch_match_size:
+            return [self.matchAllSolo(ele) for ele in coll]
+        return self._matchBatch(coll)
+
+    def _make_arrays(self):
+        """Build the arrays for batch matching. Tags are numbered, each
+        simple feature becomes a row of the tags it requires and each
+        category a column of the simple features in it"""
+        simple = self.simple
+        vocabulary = dict((tag, n) for n, tag
+                          in enumerate(sorted(self._tag_index)))
+        # Floats, as numpy only hands those to BLAS. The counts are
+        # small enough to be exact
+        required = numpy.zeros((len(simple), len(vocabulary)),
+                               numpy.float32)
+        for n, feature in enumerate(simple):
+            for tag in set(feature.tags):
+                required[n, vocabulary[tag]] = 1
+        categories = self.categories
+        members = numpy.zeros((len(simple), len(categories)),
+                              numpy.float32)
+        positions = dict((f, n) for n, f in enumerate(simple))
+        for n, category in enumerate(categories):
+            for feature in category.features:
+                members[positions[feature], n] = 1
+        return {'simple': simple,
+                'vocabulary': vocabulary,
+                'required': required.T.copy(),
+                'counts': required.sum(axis = 1),
+                'members': members,
+                'categories': categories,
+                'types': {}}
+
+    def _type_mask(self, arrays, type):
+        "Which simple features an element of a type can match"
+        masks = arrays['types']
+        if not masks.has_key(type):
+            masks[type] = numpy.array([not f.types or type in f.types
+                                       for f in arrays['simple']], bool)
+        return masks[type]
+
+    def _matchBatch(self, coll):
+        """Match a whole collection at once. Elements with the same
+        key are only matched once. The elements are turned into a
+        matrix of the tags they have, so multiplying it by the tags
+        each simple feature requires counts how many of them every
+        element has, and categories follow from the simple features"""
+        if self._arrays is None:
+            self._arrays = self._make_arrays()
+        arrays = self._arrays
+        vocabulary = arrays['vocabulary']
+        keys = {}
+        rows = []
+        order = []
+        for ele in coll:
+            magic, key = self._match_key(ele)
+            n = keys.get(key)
+            if n is None:
+                n = keys[key] = len(rows)
+                rows.append((ele['type'], key[1], magic))
+            order.append(n)
+
+        tags = numpy.zeros((len(rows), len(vocabulary)), numpy.float32)
+        simple = arrays['simple']
+        types = numpy.zeros((len(rows), len(simple)), bool)
+        for n, (type, ele_tags, magic) in enumerate(rows):
+            for tag in ele_tags:
+                tags[n, vocabulary[tag]] = 1
+            types[n] = self._type_mask(arrays, type)
+        matched = (tags.dot(arrays['required']) == arrays['counts']) & types
+        in_category = (matched.astype(numpy.float32).dot(arrays['members'])
+                       > 0)
+
+        ranks = self._ranks
+        categories = arrays['categories']
+        results = []
+        for n, (type, ele_tags, magic) in enumerate(rows):
+            features = list(magic)
+            features.extend(simple[i] for i in numpy.flatnonzero(matched[n]))
+            features.extend(categories[i]
+                            for i in numpy.flatnonzero(in_category[n]))
+            results.append(sorted(features,
+                                  key=lambda f: (-f.precision, ranks[f])))
+        return [list(results[n]) for n in order]
 
     def get(self, id):
         "Retrieve an object by index id"
@@ -27,6 +27,8 @@ class UnidentifiedElement(BaseFeature):
         return self._typecheck(ele)
 
 class UntaggedElement(BaseFeature):
+    tagged = False
+
     def __init__(self, type):
         BaseFeature.__init__(self, "untagged " + type)
         self.precision = 2
@@ -36,6 +38,8 @@ class UntaggedElement(BaseFeature):
         return self._typecheck(ele) and not ele['tags']
 
 class UnidentifiedPolygon(BaseFeature):
+    closed = True
+
     def __init__(self):
         BaseFeature.__init__(self, "unidentified polygon")
         self.precision = 3
@@ -45,6 +49,8 @@ class UnidentifiedPolygon(BaseFeature):
         return (self._typecheck(ele) and ele['nd'][0] == ele['nd'][-1])
 
 class Building(BaseFeature):
+    keys = ['building']
+
     def __init__(self):
         BaseFeature.__init__(self, "building")
         self.precision = 5
@@ -54,6 +60,8 @@ class Building(BaseFeature):
         return (self._typecheck(ele) and ele['tags'].has_key('building'))
 
 class ManMade(BaseFeature):
+    keys = ['man_made']
+
     def __init__(self):
         BaseFeature.__init__(self, "man made feature")
         self.precision = 5
@@ -63,6 +71,8 @@ class ManMade(BaseFeature):
         
 
 class Shop(BaseFeature):
+    keys = ['shop']
+
     def __init__(self):
         BaseFeature.__init__(self, "shop")
         self.precision = 6
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A feature database backed by SQLite. Features and categories are
+kept in an indexed table and only turned into objects when a match
+needs them, so processes don't each have to hold every feature."""
+
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from features import FeatureDB, SimpleFeature, Category
+
+class FeatureStore:
+    """An SQLite table of simple features and categories, with an index
+    from tags to the features which require them"""
+    def __init__(self, filename = 'features.db'):
+        self.filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread = False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS features (
+                id TEXT PRIMARY KEY, rank INTEGER, kind TEXT,
+                tagless INTEGER, data TEXT);
+            CREATE INDEX IF NOT EXISTS features_tagless
+                ON features (tagless);
+            CREATE TABLE IF NOT EXISTS tags (tag TEXT, feature TEXT);
+            CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+            CREATE TABLE IF NOT EXISTS members (
+                category TEXT, feature TEXT, rank INTEGER);
+            CREATE INDEX IF NOT EXISTS members_category
+                ON members (category);
+            """)
+            # Stores made before categories listed their features
+            # have them worked out from the features
+            if (not self._db.execute("SELECT 1 FROM members").fetchone()
+                and self._db.execute("SELECT 1 FROM features").fetchone()):
+                rows = self._db.execute(
+                    """SELECT id, rank, data FROM features
+                    WHERE kind = 'simple'""").fetchall()
+                for id, rank, data in rows:
+                    self._db.executemany(
+                        "INSERT INTO members VALUES (?, ?, ?)",
+                        [(category, id, rank) for category
+                         in json.loads(data)['categories']])
+                self._db.commit()
+
+    def save(self, db):
+        """Replace the contents of the store with the simple features
+        and categories of a FeatureDB"""
+        ids = {}
+        for rank, feature in enumerate(db.simple + db.categories):
+            # Most ids come from id() and would clash with the ids of
+            # objects in other processes
+            if feature.id == unicode(id(feature)):
+                ids[feature] = u'%s-%d' % (feature.__class__.__name__, rank)
+            else:
+                ids[feature] = feature.id
+        with self._lock:
+            self._db.execute("DELETE FROM features")
+            self._db.execute("DELETE FROM tags")
+            self._db.execute("DELETE FROM members")
+            for rank, feature in enumerate(db.simple):
+                data = {'name': feature.name,
+                        'types': feature.types,
+                        'tags': feature.tags,
+                        'categories': [ids[c] for c in feature.categories],
+                        'named': feature.named,
+                        'plural': feature.plural,
+                        'precision': feature.precision,
+                        'indefinite': feature.indefinite,
+                        'prominence': feature._prominence}
+                self._db.execute(
+                    "INSERT INTO features VALUES (?, ?, 'simple', ?, ?)",
+                    (ids[feature], rank, int(not feature.tags),
+                     json.dumps(data)))
+                self._db.executemany("INSERT INTO tags VALUES (?, ?)",
+                                     [(tag, ids[feature])
+                                      for tag in set(feature.tags)])
+                self._db.executemany("INSERT INTO members VALUES (?, ?, ?)",
+                                     [(ids[c], ids[feature], rank)
+                                      for c in feature.categories])
+            for rank, category in enumerate(db.categories):
+                data = {'name': category.name,
+                        'plural': category.plural,
+                        'precision': category.precision,
+                        'indefinite': category.indefinite}
+                self._db.execute(
+                    "INSERT INTO features VALUES (?, ?, 'category', 0, ?)",
+                    (ids[category], len(db.simple) + rank, json.dumps(data)))
+            self._db.commit()
+
+    def _query(self, sql, args = ()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def get(self, id):
+        "Return (kind, rank, data) for a feature, or None"
+        rows = self._query(
+            "SELECT kind, rank, data FROM features WHERE id = ?", (id,))
+        if rows:
+            kind, rank, data = rows[0]
+            return kind, rank, json.loads(data)
+        return None
+
+    def ids(self):
+        "Return the ids of every feature and category in order"
+        return [row[0] for row in
+                self._query("SELECT id FROM features ORDER BY rank")]
+
+    def tags(self):
+        "Return every tag some feature requires"
+        return set(row[0] for row in
+                   self._query("SELECT DISTINCT tag FROM tags"))
+
+    def tagged(self, tag):
+        "Return the ids of the features which require a tag"
+        return [row[0] for row in
+                self._query("SELECT feature FROM tags WHERE tag = ?", (tag,))]
+
+    def members(self, category):
+        "Return the ids of the features in a category in order"
+        return [row[0] for row in self._query(
+            "SELECT feature FROM members WHERE category = ? ORDER BY rank",
+            (category,))]
+
+    def tagless(self):
+        "Return the ids of the features which require no tags"
+        return [row[0] for row in self._query(
+            "SELECT id FROM features WHERE tagless = 1 ORDER BY rank")]
+
+    def count(self):
+        return self._query("SELECT count(*) FROM features")[0][0]
+
+    def close(self):
+        self._db.close()
+
+class _TagIndex:
+    """Looks like the tag index of a FeatureDB, but asks the store for
+    the features which require a tag the first time it's needed"""
+    def __init__(self, db):
+        self._db = db
+        self._tags = db._store.tags()
+        self._features = {}
+
+    def __contains__(self, tag):
+        return tag in self._tags
+
+    def __iter__(self):
+        return iter(self._tags)
+
+    def get(self, tag, default = None):
+        if tag not in self._tags:
+            return default
+        features = self._features.get(tag)
+        if features is None:
+            features = [self._db.get(id)
+                        for id in self._db._store.tagged(tag)]
+            self._features[tag] = features
+        return features
+
+class StoredFeatureDB(FeatureDB):
+    """A FeatureDB whose simple features and categories live in a
+    FeatureStore. Magic features still come from the features
+    directory."""
+    def __init__(self, filename = 'features.db', directory = 'features'):
+        if not os.path.isabs(directory):
+            directory = os.path.abspath(directory)
+        self._directory = directory
+        self._filename = filename
+        self._store = FeatureStore(filename)
+        self._store_signature = self._stat()
+        self._magic = []
+        self._index = {}
+        self._ranks = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+        self._matches = OrderedDict()
+        self._matches_lock = threading.Lock()
+        self._arrays = None
+        self._tag_index = _TagIndex(self)
+        self._tagless = [self.get(id) for id in self._store.tagless()]
+        self._magic_signature = self._magic_stat(directory)
+        if self._magic_signature:
+            self._load_magic_file(directory)
+        self._index_magic()
+        count = self._store.count()
+        for n, feature in enumerate(self._magic):
+            self._ranks[feature] = count + n
+
+    def _stat(self):
+        stat = os.stat(self._filename)
+        return (stat.st_size, stat.st_mtime)
+
+    def changed(self):
+        "Returns whether the store or the magic file changed"
+        return (self._stat() != self._store_signature
+                or self._magic_stat(self._directory) != self._magic_signature)
+
+    def version(self):
+        "A short string identifying the store and the magic file"
+        return hashlib.sha1(repr((self._store_signature,
+                                  self._magic_signature))).hexdigest()[:12]
+
+    def reload(self):
+        "Returns a new database reading the store afresh"
+        return StoredFeatureDB(self._filename, self._directory)
+
+    def _make(self, id, kind, rank, data):
+        "Turn a row of the store into a feature"
+        if kind == 'simple':
+            feature = SimpleFeature(data['name'])
+            feature.types = data['types']
+            feature.tags = data['tags']
+            feature.named = data['named']
+            feature._prominence = data['prominence']
+        else:
+            feature = Category(data['name'])
+        feature.id = id
+        feature.plural = data['plural']
+        feature.precision = data['precision']
+        feature.indefinite = data['indefinite']
+        self._index[id] = feature
+        self._ranks[feature] = rank
+        if kind == 'simple':
+            for category in data['categories']:
+                feature.category(self.get(category))
+        else:
+            # A feature being made when its category is asked for is
+            # already in the index, so this doesn't go round in circles
+            for member in self._store.members(id):
+                feature.register(self.get(member))
+        return feature
+
+    def get(self, id):
+        "Retrieve an object by index id, loading it if need be"
+        with self._lock:
+            feature = self._index.get(id)
+            if feature is None:
+                row = self._store.get(id)
+                if row is None:
+                    raise KeyError(id)
+                feature = self._make(id, *row)
+            return feature
+
+    def _load_all(self):
+        """Load every feature, which listing them or matching in a
+        batch needs"""
+        with self._lock:
+            if self._loaded:
+                return
+            features = [self.get(id) for id in self._store.ids()]
+            self._simple = [f for f in features
+                            if isinstance(f, SimpleFeature)]
+            self._categories = OrderedDict(
+                (f.name, f) for f in features if isinstance(f, Category))
+            self._loaded = True
+
+    @property
+    def simple(self):
+        "Retrieve the simple features"
+        self._load_all()
+        return self._simple
+
+    @property
+    def categories(self):
+        "Retrieve the categories"
+        self._load_all()
+        return self._categories.values()
+
+    @property
+    def features(self):
+        "Return all features"
+        return self.simple + self.categories + self._magic
+
+    @property
+    def all(self):
+        """Return all objects in the database"""
+        return self.features
+
+if __name__ == '__main__':
+    import argparse
+    argparser = argparse.ArgumentParser(
+        description="Build a feature store from a features directory")
+    argparser.add_argument('-d', '--directory', action='store',
+                           default='features', dest='directory',
+                           help = 'The features directory to read')
+    argparser.add_argument('-o', '--output', action='store',
+                           default='features.db', dest='output',
+                           help = 'The store to write')
+    args = argparser.parse_args()
+    db = FeatureDB(args.directory, snapshot = False)
+    store = FeatureStore(args.output)
+    store.save(db)
+    print "Stored %d features and %d categories in %s" % (
+        len(db.simple), len(db.categories), args.output)
+    store.close()
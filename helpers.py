@@ -1,16 +1,15 @@
 import xml.etree.ElementTree as et
-from flask import abort
+from flask import abort, request
 
 import osmapi
 import parser
 import requests
+import re
 
 import yaml
-import inflect
+import language
 import changemonger
 
-p = inflect.engine()
-
 import elements
 
 def get_node_or_404(id, version = None):
@@ -37,6 +36,40 @@ def get_changeset_or_404(id):
     # and from the osmchange
     return changemonger.changeset(id)
 
+def get_changeset_summary_or_404(id):
+    # Returns the changeset along with its sentence
+    return changemonger.changeset_summary(id)
+
+# The most ids a single bulk request may ask for
+bulk_limit = 1000
+
+_id_re = re.compile(r'^[0-9]+$')
+_versioned_id_re = re.compile(r'^[0-9]+(v[0-9]+)?$')
+
+def get_ids_or_400(versioned = False):
+    # Bulk requests give their ids as a comma separated ids parameter
+    # or as a JSON list in the body. Elements may also be asked for
+    # at a version, as in 12v3
+    if request.json is not None:
+        ids = request.json
+        if isinstance(ids, dict):
+            ids = ids.get('ids')
+        if not isinstance(ids, list):
+            abort(400, "Expected a list of ids")
+    else:
+        ids = [i for i in request.values.get('ids', '').split(',') if i]
+    ids = [unicode(i).strip() for i in ids]
+    valid = _versioned_id_re if versioned else _id_re
+    if not all(valid.match(i) for i in ids):
+        abort(400, "Ids must be numbers")
+    ids = [str(i) for i in ids]
+    if not ids:
+        abort(400, "No ids given")
+    if len(ids) > bulk_limit:
+        abort(400, "No more than %d ids may be asked for at once"
+              % bulk_limit)
+    return ids
+
 def get_feature_or_404(id):
     try:
         return changemonger.db.get(id)
@@ -50,11 +83,11 @@ def grouped_to_english(coll):
     l = []
     for elements, feature in coll:
         if len(elements) > 1:
-            l.append("%s %s" % (p.number_to_words(len(elements)),
+            l.append("%s %s" % (language.number_to_words(len(elements)),
                                 feature.plural))
         else:            
             l.append(elements.display_name(elements[0], feature))
-    return p.join(l)
+    return language.join(l)
 
 def sentence_from_changeset(cset):
     """Take a changeset object and return a sentence"""
@@ -0,0 +1,77 @@
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cached wrappers around inflect. Feature names have their plurals
+and articles worked out when the feature database loads, and the
+strings which come from elements, such as brands and operators, are
+remembered here so the same words aren't inflected over and over"""
+
+import threading
+from functools import wraps
+from collections import OrderedDict
+import inflect
+
+engine = inflect.engine()
+
+# How many results each cached function keeps
+cache_size = 4096
+
+def memoize(size = None):
+    """Remember the most recently used results of a function of one
+    argument"""
+    def decorator(fn):
+        results = OrderedDict()
+        lock = threading.Lock()
+        @wraps(fn)
+        def wrapper(arg):
+            with lock:
+                result = results.pop(arg, None)
+                if result is not None:
+                    results[arg] = result
+                    return result
+            result = fn(arg)
+            with lock:
+                results[arg] = result
+                while len(results) > (size or cache_size):
+                    results.popitem(last = False)
+            return result
+        wrapper.clear = results.clear
+        return wrapper
+    return decorator
+
+@memoize()
+def plural(word):
+    "Returns the plural of a noun"
+    return engine.plural(word)
+
+@memoize()
+def a(word):
+    "Returns a word with its indefinite article"
+    return engine.a(word)
+
+@memoize()
+def number_to_words(number):
+    "Returns a number in words"
+    return engine.number_to_words(number)
+
+def join(words):
+    "Joins words into an English list"
+    # Lists of one or two words are common and simple
+    if len(words) == 1:
+        return words[0]
+    elif len(words) == 2:
+        return "%s and %s" % tuple(words)
+    return engine.join(words)
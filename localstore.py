@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A local element store built from OSM extracts, which can answer
+parent way and relation lookups without going to the API"""
+
+import sys
+import sqlite3
+import json
+import gzip
+import bz2
+import threading
+import Queue
+import logging
+import parser
+from model import Element
+
+# How many elements are written per transaction while importing
+batch_size = 10000
+# How many batches of elements a PBF import reads ahead of the store
+pbf_queue_size = 4
+
+def open_file(fname):
+    """Open a possibly compressed OSM file for reading"""
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    elif fname.endswith('.bz2'):
+        return bz2.BZ2File(fname, 'rb')
+    else:
+        return open(fname, 'rb')
+
+def iterparsePBF(fname):
+    """Yield elements from a PBF file. This needs imposm.parser, which
+    doesn't provide versions or metadata, so elements only carry their
+    ids, tags and references. The file is parsed in another thread
+    which hands over one callback's worth of elements at a time, and
+    waits while pbf_queue_size batches are still to be read, so the
+    extract is never held in memory all at once.
+    """
+    from imposm.parser import OSMParser
+    batches = Queue.Queue(pbf_queue_size)
+    done = object()
+    errors = []
+    def nodes(items):
+        batches.put([{'type': 'node', 'id': id,
+                      'lon': str(coords[0]), 'lat': str(coords[1]),
+                      'tags': tags}
+                     for id, tags, coords in items])
+    def ways(items):
+        batches.put([{'type': 'way', 'id': id, 'tags': tags, 'nd': refs}
+                     for id, tags, refs in items])
+    def relations(items):
+        batches.put([{'type': 'relation', 'id': id, 'tags': tags,
+                      'members': [{'type': type, 'ref': ref, 'role': role}
+                                  for ref, type, role in members]}
+                     for id, tags, members in items])
+    def parse():
+        try:
+            OSMParser(concurrency = 1, nodes_callback = nodes,
+                      ways_callback = ways,
+                      relations_callback = relations).parse(fname)
+        except:
+            errors.append(sys.exc_info())
+        finally:
+            batches.put(done)
+    thread = threading.Thread(target = parse)
+    thread.daemon = True
+    thread.start()
+    while True:
+        batch = batches.get()
+        if batch is done:
+            break
+        for ele in batch:
+            yield Element.fromdict(ele)
+    thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+class ElementStore:
+    """An SQLite store of elements with node to way and member to
+    relation indexes"""
+    def __init__(self, filename = 'osm.db'):
+        """Open (or create) the store"""
+        self.filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread = False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS elements (
+                type TEXT, id INTEGER, data TEXT,
+                PRIMARY KEY (type, id));
+            CREATE TABLE IF NOT EXISTS way_nodes (
+                node INTEGER, way INTEGER);
+            CREATE INDEX IF NOT EXISTS way_nodes_node ON way_nodes (node);
+            CREATE INDEX IF NOT EXISTS way_nodes_way ON way_nodes (way);
+            CREATE TABLE IF NOT EXISTS members (
+                type TEXT, ref INTEGER, relation INTEGER);
+            CREATE INDEX IF NOT EXISTS members_ref ON members (type, ref);
+            CREATE INDEX IF NOT EXISTS members_relation
+                ON members (relation);
+            """)
+
+    def _put(self, ele):
+        "Insert or replace an element and its index entries"
+        data = dict((k, v) for k, v in ele.todict().items()
+                    if not k.startswith('_'))
+        id = int(ele['id'])
+        self._db.execute("INSERT OR REPLACE INTO elements VALUES (?, ?, ?)",
+                         (ele['type'], id, json.dumps(data)))
+        if ele['type'] == 'way':
+            self._db.execute("DELETE FROM way_nodes WHERE way = ?", (id,))
+            self._db.executemany("INSERT INTO way_nodes VALUES (?, ?)",
+                                 [(int(nd), id) for nd in set(ele['nd'])])
+        elif ele['type'] == 'relation':
+            self._db.execute("DELETE FROM members WHERE relation = ?", (id,))
+            self._db.executemany(
+                "INSERT INTO members VALUES (?, ?, ?)",
+                set((m['type'], int(m['ref']), id) for m in ele['members']))
+
+    def _delete(self, type, id):
+        "Remove an element and its index entries"
+        id = int(id)
+        self._db.execute("DELETE FROM elements WHERE type = ? AND id = ?",
+                         (type, id))
+        if type == 'way':
+            self._db.execute("DELETE FROM way_nodes WHERE way = ?", (id,))
+        elif type == 'relation':
+            self._db.execute("DELETE FROM members WHERE relation = ?", (id,))
+
+    def load(self, eles):
+        """Load a stream of elements into the store, returning how many
+        were loaded"""
+        n = 0
+        with self._lock:
+            for ele in eles:
+                self._put(ele)
+                n += 1
+                if n % batch_size == 0:
+                    self._db.commit()
+                    logging.debug("Loaded %d elements" % n)
+            self._db.commit()
+        return n
+
+    def import_file(self, fname):
+        """Import an OSM XML (optionally gzip or bzip2 compressed) or
+        PBF extract"""
+        if fname.endswith('.pbf'):
+            return self.load(iterparsePBF(fname))
+        fd = open_file(fname)
+        try:
+            return self.load(parser.iterparseOSM(fd))
+        finally:
+            fd.close()
+
+    def apply_change(self, fname):
+        """Apply an osmChange diff to keep the store current, returning
+        how many elements were changed"""
+        fd = open_file(fname)
+        n = 0
+        try:
+            with self._lock:
+                for ele in parser.iterparseChange(fd):
+                    if ele['_action'] == 'delete':
+                        self._delete(ele['type'], ele['id'])
+                    else:
+                        self._put(ele)
+                    n += 1
+                self._db.commit()
+        finally:
+            fd.close()
+        return n
+
+    def _load(self, data):
+        "Turn a stored row back into an element"
+        return Element.fromdict(json.loads(data))
+
+    def get(self, type, id):
+        "Return an element, or None if it isn't in the store"
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM elements WHERE type = ? AND id = ?",
+                (type, int(id))).fetchone()
+        if row:
+            return self._load(row[0])
+        return None
+
+    def ways_for_node(self, id):
+        "Return the ways which use a node"
+        with self._lock:
+            rows = self._db.execute(
+                """SELECT data FROM elements WHERE type = 'way' AND id IN
+                (SELECT way FROM way_nodes WHERE node = ?) ORDER BY id""",
+                (int(id),)).fetchall()
+        return [self._load(row[0]) for row in rows]
+
+    def relations_for_element(self, type, id):
+        "Return the relations which contain an element"
+        with self._lock:
+            rows = self._db.execute(
+                """SELECT data FROM elements WHERE type = 'relation' AND
+                id IN (SELECT relation FROM members
+                       WHERE type = ? AND ref = ?) ORDER BY id""",
+                (type, int(id))).fetchall()
+        return [self._load(row[0]) for row in rows]
+
+    def close(self):
+        self._db.close()
+
+if __name__ == '__main__':
+    import argparse
+    argparser = argparse.ArgumentParser(
+        description="Build or update a local element store")
+    argparser.add_argument('-d', '--db', action='store', default='osm.db',
+                           dest='db', help = 'The store to write to')
+    argparser.add_argument('-c', '--change', action='store_true',
+                           default=False, dest='change',
+                           help = 'Apply the files as osmChange diffs')
+    argparser.add_argument('files', nargs='+',
+                           help = 'OSM extracts or osmChange files')
+    args = argparser.parse_args()
+    store = ElementStore(args.db)
+    for fname in args.files:
+        if args.change:
+            print "Applied %d changes from %s" % (
+                store.apply_change(fname), fname)
+        else:
+            print "Imported %d elements from %s" % (
+                store.import_file(fname), fname)
+    store.close()
@@ -0,0 +1,131 @@
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Simple counters and histograms which can be rendered in the
+Prometheus text format"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+_registry = []
+_lock = threading.Lock()
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60)
+
+def _escape(value):
+    "Escape a label value"
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def _labels(labels, extra = ()):
+    "Format a set of labels"
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in items)
+
+def _number(value):
+    "Format a number the way Prometheus expects"
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Counter:
+    """A value which only goes up"""
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        with _lock:
+            _registry.append(self)
+
+    def inc(self, amount = 1, **labels):
+        "Add to the counter"
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name + _labels(key), value
+
+class Histogram:
+    """Counts observations into buckets, with their sum and count"""
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets = default_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        with _lock:
+            _registry.append(self)
+
+    def observe(self, value, **labels):
+        "Record an observation"
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        "Observe how long the body of a with statement takes"
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield (self.name + '_bucket' +
+                       _labels(key, [('le', _number(bound))]), count)
+            yield self.name + '_sum' + _labels(key), total
+            yield self.name + '_count' + _labels(key), counts[-1]
+
+def render():
+    """Return every metric in the Prometheus text format"""
+    lines = []
+    with _lock:
+        for metric in _registry:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, _number(value)))
+    return '\n'.join(lines) + '\n'
+
+stage_seconds = Histogram('changemonger_stage_seconds',
+                          'Time spent in each stage of summarizing')
+api_requests = Counter('changemonger_osmapi_requests_total',
+                       'Requests made to the OSM API')
+api_request_seconds = Histogram('changemonger_osmapi_request_seconds',
+                                'Time spent waiting on the OSM API')
+api_retries = Counter('changemonger_osmapi_retries_total',
+                      'OSM API requests retried after failing')
+api_bytes = Counter('changemonger_osmapi_bytes_total',
+                    'Bytes downloaded from the OSM API')
+cache_lookups = Counter('changemonger_osmapi_cache_total',
+                        'OSM API cache lookups by result')
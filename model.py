@@ -0,0 +1,187 @@
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compact element objects which can be used like the dicts elements
+used to be. Ids, versions, changesets and uids are integers, tag and
+user strings are interned and way nodes are kept in an array."""
+
+from array import array
+
+# Node ids need 64 bits. Older Pythons don't have the 'q' typecode, but
+# 'l' is 64 bits wide on the platforms we run on
+try:
+    array('q')
+    _ref_type = 'q'
+except ValueError:
+    _ref_type = 'l'
+
+def _intern(s):
+    """Intern a string. Plain ASCII unicode strings become str first,
+    which is what ElementTree hands back for them anyway"""
+    if isinstance(s, unicode):
+        try:
+            s = s.encode('ascii')
+        except UnicodeError:
+            return s
+    return intern(s)
+
+_missing = object()
+
+class _Mapping(object):
+    """Dict style access to the slots of an object. Unset slots look
+    like missing keys"""
+    __slots__ = ()
+    _keys = frozenset()
+
+    def _lookup(self, key):
+        "Return the value for a key, or _missing"
+        if key in self._keys:
+            return getattr(self, key, _missing)
+        return _missing
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _missing
+
+    def has_key(self, key):
+        return self._lookup(key) is not _missing
+
+    def get(self, key, default = None):
+        value = self._lookup(key)
+        if value is _missing:
+            return default
+        return value
+
+    def keys(self):
+        return [key for key in self.__slots__ if key in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __repr__(self):
+        return repr(self.todict())
+
+class Member(_Mapping):
+    """A relation member"""
+    __slots__ = ('type', 'ref', 'role')
+    _keys = frozenset(__slots__)
+
+    def __init__(self, type, ref, role):
+        self.type = _intern(type)
+        self.ref = int(ref)
+        self.role = _intern(role)
+
+    def todict(self):
+        return {'type': self.type, 'ref': self.ref, 'role': self.role}
+
+class Element(_Mapping):
+    """A node, way or relation"""
+    __slots__ = ('type', 'id', 'version', 'changeset', 'uid', 'user',
+                 'timestamp', 'visible', 'lat', 'lon', 'tags', '_tags',
+                 'nd', 'members', '_action', '_changeset_tags', '_ways',
+                 '_relations', '_extra')
+    _keys = frozenset(__slots__) - frozenset(['_extra'])
+    _ints = frozenset(['id', 'version', 'changeset', 'uid'])
+    _interned = frozenset(['type', 'user', 'visible', '_action'])
+
+    def __init__(self, type, attribs = None):
+        self.type = _intern(type)
+        self.tags = {}
+        self._tags = ()
+        if type == 'way':
+            self.nd = array(_ref_type)
+        elif type == 'relation':
+            self.members = []
+        if attribs:
+            for k, v in attribs.items():
+                self[k] = v
+
+    @classmethod
+    def fromdict(cls, d):
+        """Make an element from a dict, such as one from todict"""
+        ele = cls(d['type'])
+        for k, v in d.items():
+            if k == 'tags':
+                ele.settags(v)
+            elif k == 'nd':
+                ele.nd = array(_ref_type, [int(ref) for ref in v])
+            elif k == 'members':
+                ele.members = [Member(m['type'], m['ref'], m['role'])
+                               for m in v]
+            elif k != 'type' and k != '_tags':
+                ele[k] = v
+        return ele
+
+    def settags(self, tags):
+        "Set the tags of the element, interning their strings"
+        self.tags = dict((_intern(k), _intern(v)) for k, v in tags.items())
+        self._tags = tuple(_intern('%s=%s' % (k, v))
+                           for k, v in self.tags.items())
+
+    def _lookup(self, key):
+        if key in self._keys:
+            return getattr(self, key, _missing)
+        extra = getattr(self, '_extra', None)
+        if extra:
+            return extra.get(key, _missing)
+        return _missing
+
+    def __setitem__(self, key, value):
+        if key in self._ints:
+            value = int(value)
+        elif key in self._interned:
+            value = _intern(value)
+        if key in self._keys:
+            setattr(self, key, value)
+        else:
+            if not hasattr(self, '_extra'):
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._keys and hasattr(self, key):
+            delattr(self, key)
+        elif key in getattr(self, '_extra', ()):
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def keys(self):
+        keys = [key for key in self.__slots__
+                if key in self._keys and hasattr(self, key)]
+        keys.extend(getattr(self, '_extra', ()))
+        return keys
+
+    def todict(self):
+        """Return the element as a plain dict"""
+        d = dict(self.items())
+        if 'nd' in d:
+            d['nd'] = list(d['nd'])
+        if 'members' in d:
+            d['members'] = [m.todict() for m in d['members']]
+        d['_tags'] = list(d['_tags'])
+        return d
@@ -17,84 +17,444 @@
 """Provides a simple abstraction against the OSM API"""
 
 import requests
-import requests_cache
 import logging
+import re
+import time
+import zlib
+import threading
+import cache as _cache
+import metrics
 
 logging.basicConfig(level=logging.DEBUG)
 
-rs = requests.session(headers={'user-agent': 'changemonger/0.0.1'})
-requests_cache.configure('osm_cache')
+class TokenBucket:
+    """Limits how often something happens. Up to burst calls go
+    through at once, after which they're spaced to rate per second.
+    Callers queue for tokens, so many threads share the rate fairly
+    rather than all retrying at once."""
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
 
-server = 'api.openstreetmap.org'
+    def acquire(self):
+        "Wait for a token"
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._last) * self.rate)
+            self._last = now
+            # Taking the token now, even if it's overdrawn, holds a
+            # place in line for it
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        "Hold everyone back for a while, such as when the server asks"
+        with self._lock:
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+def _once(fn):
+    "Wrap a function of no arguments so only its first call happens"
+    lock = threading.Lock()
+    called = []
+    def wrapper():
+        with lock:
+            if called:
+                return
+            called.append(True)
+        fn()
+    return wrapper
+
+class Client:
+    """A connection to an OSM API server. Connections are pooled and
+    kept alive, responses are compressed, requests are rate limited
+    and throttled or failed requests are retried with exponential
+    backoff."""
+    def __init__(self, endpoint = 'http://api.openstreetmap.org/api/0.6',
+                 pool_size = 10, timeout = 30, rate = 10, burst = 20,
+                 retries = 5, backoff = 1, max_backoff = 60):
+        self.endpoint = endpoint.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = TokenBucket(rate, burst)
+        # No more requests at once than there are pooled connections
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self.session = requests.session(
+            headers={'user-agent': 'changemonger/0.0.1',
+                     'accept-encoding': 'gzip'},
+            timeout = timeout,
+            config = {'pool_connections': pool_size,
+                      'pool_maxsize': pool_size,
+                      'keep_alive': True})
+
+    @property
+    def server(self):
+        "The host name of the server"
+        return self.endpoint.split('://', 1)[-1].split('/', 1)[0]
+
+    def url(self, path):
+        "The URL of an API call"
+        return self.endpoint + path
+
+    def _delay(self, attempt, r = None):
+        """How long to wait before retrying, which is what the server
+        asked for or else doubles with every attempt"""
+        if r is not None and r.headers.get('retry-after'):
+            try:
+                return float(r.headers['retry-after'])
+            except ValueError:
+                pass
+        return min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    def get(self, url, **kwargs):
+        """Make a GET request, retrying it when the server is busy or
+        failing. Raises an HTTPError if it never succeeds."""
+        endpoint = _endpoint(url)
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            metrics.api_requests.inc(endpoint = endpoint)
+            start = time.time()
+            r = None
+            self._slots.acquire()
+            release = _once(self._slots.release)
+            try:
+                r = self.session.get(url, **kwargs)
+            except (requests.exceptions.Timeout,
+                    requests.exceptions.ConnectionError), msg:
+                release()
+                if attempt >= self.retries:
+                    raise
+                logging.warning("Retrying %s after %s" % (url, msg))
+            except:
+                release()
+                raise
+            finally:
+                metrics.api_request_seconds.observe(time.time() - start,
+                                                    endpoint = endpoint)
+            if r is not None:
+                if not (r.status_code == 429 or r.status_code >= 500):
+                    break
+                if attempt >= self.retries:
+                    break
+                release()
+                logging.warning("Retrying %s after status %s" % (
+                    url, r.status_code))
+            delay = self._delay(attempt, r)
+            metrics.api_retries.inc(endpoint = endpoint)
+            if r is not None and r.status_code == 429:
+                # Throttling applies to everyone, so everyone waits
+                # for the limiter, this caller included
+                self.limiter.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+        if r.status_code >= 400 or kwargs.get('prefetch',
+                                              self.session.prefetch):
+            release()
+        else:
+            # The connection stays in use until the body has been read,
+            # so the slot goes back when a _StreamReader finishes
+            r.release = release
+        r.raise_for_status()
+        return r
+
+client = Client()
+
+def configure(**kwargs):
+    """Replace the client, taking the same arguments as Client"""
+    global client
+    client = Client(**kwargs)
+
+cache = _cache.Cache('osm_cache')
+
+# How long, in seconds, responses which can still change are cached
+# for. Versioned elements and closed changesets are cached forever.
+mutable_ttl = 3600
+# How long open changesets are cached for
+open_ttl = 60
+# How long empty "no parent ways/relations" answers are cached for
+negative_ttl = 600
+
+# The longest id list sent in a single multi-fetch request, which keeps
+# the URL well under what servers and proxies accept
+max_ids_length = 2000
+
+_empty_re = re.compile(r'<osm\b[^>]*(/>|>\s*</osm>)')
+_closed_re = re.compile(r'\bopen=["\']false["\']')
+_id_re = re.compile(r'/\d+')
+
+def _endpoint(url):
+    "Turn a URL into a metrics label, such as /node/:id/ways"
+    path = url[len(client.endpoint):].split('?', 1)[0]
+    return _id_re.sub('/:id', path)
+
+def _request(url, **kwargs):
+    "Make a request to the API through the client"
+    return client.get(url, **kwargs)
+
+class _StreamReader:
+    """Reads a streamed response, counting the bytes which come over
+    the wire and decompressing them if need be"""
+    def __init__(self, r):
+        self._source = r.raw
+        self._buffer = ''
+        self._done = False
+        # Hands the client's connection slot back
+        self._release = getattr(r, 'release', lambda: None)
+        if r.headers.get('content-encoding') == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = None
+
+    def _read(self, size):
+        try:
+            data = self._source.read(size)
+        except:
+            self.close()
+            raise
+        if not data:
+            self._release()
+        metrics.api_bytes.inc(len(data))
+        return data
+
+    def close(self):
+        """Give up on the rest of the response. The connection isn't
+        reused, and closes once the response is dropped."""
+        self._release()
+
+    def __del__(self):
+        # Readers which are dropped part way still free their slot
+        self._release()
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            # The raw response can't be asked for everything at once:
+            # it waits for the server to close the connection, or
+            # gives nothing back for chunked responses
+            chunks = []
+            while True:
+                data = self.read(64 * 1024)
+                if not data:
+                    return ''.join(chunks)
+                chunks.append(data)
+        if self._decompressor is None:
+            return self._read(size)
+        while not self._done and len(self._buffer) < size:
+            data = self._read(max(size, 1024))
+            if data:
+                self._buffer += self._decompressor.decompress(data)
+            else:
+                self._buffer += self._decompressor.flush()
+                self._done = True
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def _get(url, ttl = None):
+    """Retrieve a URL through the cache. ttl is how many seconds the
+    response stays fresh for (None is forever), or a function taking
+    the response text and returning that
+    """
+    data = cache.get(url)
+    if data is not None:
+        metrics.cache_lookups.inc(result = 'hit')
+        return data
+    metrics.cache_lookups.inc(result = 'miss')
+    # Read through _StreamReader so api_bytes counts what came over
+    # the wire, as it does for streamed downloads
+    r = _request(url, prefetch=False)
+    text = _StreamReader(r).read().decode(r.encoding or 'utf-8', 'replace')
+    if callable(ttl):
+        ttl = ttl(text)
+    cache.set(url, text, ttl)
+    return text
+
+def _parentsTTL(data):
+    "Parent lookups which found nothing are cached separately"
+    if _empty_re.search(data):
+        return negative_ttl
+    return mutable_ttl
+
+def _changesetTTL(data):
+    "Closed changesets never change"
+    if _closed_re.search(data):
+        return None
+    return open_ttl
 
 def getNode(id, version = None):
     id = str(id)
     if version:
-        url = "http://%s/api/0.6/node/%s/%s" % (server, id, str(version))
+        url = client.url("/node/%s/%s" % (id, str(version)))
     else:
-        url = "http://%s/api/0.6/node/%s" % (server, id)
+        url = client.url("/node/%s" % id)
     logging.debug("Retrieving %s for node %s version %s" % (
         url, id, version))
-    r = rs.get(url)
-    r.raise_for_status()
-    return r.text
+    if version:
+        return _get(url)
+    return _get(url, mutable_ttl)
 
 def getWay(id, version = None):
     id = str(id)
     if version:
-        url = "http://%s/api/0.6/way/%s/%s" % (server, id, str(version))
+        url = client.url("/way/%s/%s" % (id, str(version)))
     else:
-        url = "http://%s/api/0.6/way/%s" % (server, id)
+        url = client.url("/way/%s" % id)
     logging.debug("Retrieving %s for way %s version %s" % (
         url, id, version))
-    r = rs.get(url)
-    r.raise_for_status()
-    return r.text
+    if version:
+        return _get(url)
+    return _get(url, mutable_ttl)
 
 def getRelation(id, version = None):
     id = str(id)
     if version:
-        url = "http://%s/api/0.6/relation/%s/%s" % (server, id, str(version))
+        url = client.url("/relation/%s/%s" % (id, str(version)))
     else:
-        url = "http://%s/api/0.6/relation/%s" % (server, id)
+        url = client.url("/relation/%s" % id)
     logging.debug("Retrieving %s for relation %s version %s" % (
         url, id, version))
-    r = rs.get(url)
-    r.raise_for_status()
-    return r.text
+    if version:
+        return _get(url)
+    return _get(url, mutable_ttl)
+
+def idString(i):
+    """Turn an id, or an (id, version) tuple, into the form multi-fetch
+    calls take, such as 12 or 12v3"""
+    if isinstance(i, tuple):
+        id, version = i
+        return "%sv%s" % (id, version) if version else str(id)
+    return str(i)
+
+def _idChunks(ids):
+    """Turn ids (or (id, version) tuples) into comma separated lists
+    short enough to go in a URL"""
+    chunk = []
+    length = 0
+    for i in ids:
+        i = idString(i)
+        if chunk and length + len(i) + 1 > max_ids_length:
+            yield ','.join(chunk)
+            chunk = []
+            length = 0
+        chunk.append(i)
+        length += len(i) + 1
+    if chunk:
+        yield ','.join(chunk)
+
+def _fetchMany(type, chunk):
+    "Fetch one comma separated list of elements"
+    url = client.url("/%ss?%ss=%s" % (type, type, chunk))
+    logging.debug("Retrieving %s for %d %ss" % (
+        url, chunk.count(',') + 1, type))
+    # Lists made up only of versioned elements never change
+    if all('v' in i for i in chunk.split(',')):
+        return _get(url)
+    else:
+        return _get(url, mutable_ttl)
+
+def _splitMany(type, ids):
+    """Fetch a list of ids, yielding (ids, body, error) for it. The API
+    refuses a whole request if any element in it is missing, so a
+    refused list is fetched again in halves until the missing elements
+    are on their own."""
+    try:
+        yield ids, _fetchMany(type, ','.join(ids)), None
+        return
+    except requests.exceptions.HTTPError, msg:
+        status = getattr(getattr(msg, 'response', None), 'status_code', None)
+        error = msg
+    except requests.exceptions.RequestException, msg:
+        status = None
+        error = msg
+    logging.debug("Couldn't retrieve %d %ss: %s" % (len(ids), type, error))
+    if len(ids) > 1 and status in (400, 404, 410):
+        half = len(ids) // 2
+        for part in (ids[:half], ids[half:]):
+            for result in _splitMany(type, part):
+                yield result
+    elif status in (404, 410):
+        yield ids, None, "Not found"
+    else:
+        yield ids, None, str(error)
+
+def iterMany(type, ids):
+    """Fetch many elements of one type using the multi-fetch call,
+    yielding the ids in each request, its response body as it arrives
+    and an error message. Elements which can't be fetched come in
+    requests of their own where possible, with a body of None and the
+    reason as the error."""
+    for chunk in _idChunks(ids):
+        for result in _splitMany(type, chunk.split(',')):
+            yield result
+
+def _getMany(type, ids):
+    """Fetch many elements of one type, returning the response bodies.
+    Elements which can't be fetched are left out."""
+    return [body for chunk, body, error in iterMany(type, ids)
+            if body is not None]
+
+def getNodes(ids):
+    return _getMany('node', ids)
+
+def getWays(ids):
+    return _getMany('way', ids)
+
+def getRelations(ids):
+    return _getMany('relation', ids)
 
 def getChangeset(id):
     id = str(id)
-    url = "http://%s/api/0.6/changeset/%s" % (server, id)
+    url = client.url("/changeset/%s" % id)
     logging.debug("Retrieving %s for changeset %s metadata" % (
         url, id))
-    r = rs.get(url)
-    r.raise_for_status()
-    return r.text
+    return _get(url, _changesetTTL)
 
-def getChange(id):
+def getChange(id, closed = False):
     id = str(id)
-    url = "http://%s/api/0.6/changeset/%s/download" % (server, id)
+    url = client.url("/changeset/%s/download" % id)
     logging.debug("Retrieving %s for changeset %s data" % (
         url, id))
-    r = rs.get(url)
-    r.raise_for_status()
-    return r.text
+    if closed:
+        return _get(url)
+    return _get(url, open_ttl)
+
+def getChangeStream(id, closed = False):
+    """Returns the osmChange for a changeset as a file-like object
+    which can be read incrementally. Closed changesets are cached on
+    disk as they're read"""
+    id = str(id)
+    url = client.url("/changeset/%s/download" % id)
+    if closed:
+        fd = cache.open(url)
+        if fd:
+            metrics.cache_lookups.inc(result = 'hit')
+            return fd
+        metrics.cache_lookups.inc(result = 'miss')
+    logging.debug("Streaming %s for changeset %s data" % (
+        url, id))
+    r = _request(url, prefetch=False)
+    raw = _StreamReader(r)
+    if closed:
+        return cache.tee(raw, url)
+    return raw
 
 def getWaysforNode(id):
     id = str(id)
-    url = "http://%s/api/0.6/node/%s/ways" % (server, id)
+    url = client.url("/node/%s/ways" % id)
     logging.debug("Retrieving %s for node %s ways" % (url, id))
-    r = rs.get(url)
-    r.raise_for_status()
-    return r.text
+    return _get(url, _parentsTTL)
 
 def getRelationsforElement(type, id):
     type = str(type)
     id = str(id)
-    url = "http://%s/api/0.6/%s/%s/relations" % (server, type, id)
+    url = client.url("/%s/%s/relations" % (type, id))
     logging.debug("Retrieving %s for %s %s relations" % (url, type, id))
-    r = rs.get(url)
-    r.raise_for_status()
-    return r.text
+    return _get(url, _parentsTTL)
 
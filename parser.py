@@ -1,3 +1,6 @@
+import xml.etree.ElementTree as et
+from model import Element, Member
+
 def dict2list(d):
     """Function that turns a dictionary into a list of key=value strings"""
     l = []
@@ -18,31 +21,23 @@ def parseAttribs (attribs):
     return d
 
 def parseNode (node):
-    d = {'type': 'node'}
-    d.update(parseAttribs(node.attrib))
-    d['tags'] = parseTags(node.findall('tag'))
-    d['_tags'] = dict2list(d['tags'])
-    return d
+    ele = Element('node', node.attrib)
+    ele.settags(parseTags(node.findall('tag')))
+    return ele
 
 def parseWay (way):
-    d = {'type': 'way', 'nd': []}
-    d.update(parseAttribs(way.attrib))
-    for nd in way.findall('nd'):
-        d['nd'].append(nd.attrib['ref'])
-    d['tags'] = parseTags(way.findall('tag'))
-    d['_tags'] = dict2list(d['tags'])
-    return d
+    ele = Element('way', way.attrib)
+    ele.nd.extend(int(nd.attrib['ref']) for nd in way.findall('nd'))
+    ele.settags(parseTags(way.findall('tag')))
+    return ele
 
 def parseRelation (rel):
-    d = {'type': 'relation', 'members': []}
-    d.update(parseAttribs(rel.attrib))
+    ele = Element('relation', rel.attrib)
     for m in rel.findall('member'):
-        d['members'].append({'type': m.attrib['type'],
-                             'ref': m.attrib['ref'],
-                             'role': m.attrib['role']})
-    d['tags'] = parseTags(rel.findall('tag'))
-    d['_tags'] = dict2list(d['tags'])
-    return d
+        ele.members.append(Member(m.attrib['type'], m.attrib['ref'],
+                                  m.attrib['role']))
+    ele.settags(parseTags(rel.findall('tag')))
+    return ele
 
 def parseChange (osmchange):
     c = []
@@ -60,6 +55,54 @@ def parseChange (osmchange):
         c.append((action.tag, elements))
     return c
 
+def iterparseChange (source):
+    """Incrementally parse an osmChange document from a file-like
+    object, yielding elements one at a time. Each element is removed
+    from the tree once it's parsed so memory use stays flat.
+    """
+    parsers = {'node': parseNode,
+               'way': parseWay,
+               'relation': parseRelation}
+    context = iter(et.iterparse(source, events=('start', 'end')))
+    event, root = next(context)
+    action = None
+    depth = 1
+    for event, element in context:
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                action = element
+            continue
+        depth -= 1
+        if depth == 1:
+            root.remove(element)
+        elif depth == 2 and element.tag in parsers:
+            ele = parsers[element.tag](element)
+            ele['_action'] = action.tag
+            action.remove(element)
+            yield ele
+
+def iterparseOSM (source):
+    """Incrementally parse an OSM document, such as an extract, from a
+    file-like object, yielding elements one at a time and dropping
+    them from the tree once they're parsed.
+    """
+    parsers = {'node': parseNode,
+               'way': parseWay,
+               'relation': parseRelation}
+    context = iter(et.iterparse(source, events=('start', 'end')))
+    event, root = next(context)
+    depth = 1
+    for event, element in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            root.remove(element)
+            if element.tag in parsers:
+                yield parsers[element.tag](element)
+
 def parseChangeset (changeset):
     d = {'type': 'changeset'}
     d.update(parseAttribs(changeset.attrib))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Summarizes every changeset in a directory of minutely or hourly
+replication diffs, writing one JSON line per changeset"""
+
+import os
+import sys
+import time
+import json
+import logging
+import cPickle as pickle
+from collections import OrderedDict
+
+import parser
+import changemonger
+from localstore import open_file
+
+def sequence_path(directory, seq):
+    """Return the path of a replication diff, in the usual
+    AAA/BBB/CCC.osc.gz layout"""
+    return os.path.join(directory, '%03d' % (seq // 1000000),
+                        '%03d' % (seq // 1000 % 1000),
+                        '%03d.osc.gz' % (seq % 1000))
+
+def read_state(directory):
+    """Return the latest sequence number from a replication
+    directory's state.txt, or None"""
+    try:
+        with open(os.path.join(directory, 'state.txt')) as fd:
+            for line in fd:
+                if line.startswith('sequenceNumber='):
+                    return int(line.split('=', 1)[1])
+    except IOError:
+        pass
+    return None
+
+def summarize(id, eles, remote = False):
+    """Take the elements of one changeset gathered from diffs and
+    return its summary as a dict"""
+    actions = []
+    seen = {}
+    for ele in eles:
+        if ele['_action'] not in seen:
+            seen[ele['_action']] = []
+            actions.append((ele['_action'], seen[ele['_action']]))
+        seen[ele['_action']].append(ele)
+    # Ids are written as strings, as batch.py writes them, so the two
+    # outputs can be joined
+    id = str(id)
+    user = eles[0].get('user') or 'User %s' % eles[0].get('uid')
+    cset = {'type': 'changeset', 'id': id, 'user': user,
+            'actions': actions,
+            'elements': changemonger.link(list(eles), remote)}
+    return {'changeset': id,
+            'user': user,
+            'elements': len(eles),
+            'sentence': changemonger.changeset_sentence(cset)}
+
+class Processor:
+    """Reads replication diffs in sequence, grouping elements by
+    changeset. A changeset is summarized once it hasn't been seen for
+    a few diffs, or early if too many elements are waiting.
+    """
+    def __init__(self, directory, output, checkpoint, idle = 2,
+                 max_elements = 100000, remote = False):
+        """Initialize the processor. output is a file to write JSON
+        lines to and checkpoint is where progress is saved"""
+        self.directory = directory
+        self.output = output
+        self.checkpoint = checkpoint
+        self.idle = idle
+        self.max_elements = max_elements
+        self.remote = remote
+        self.sequence = None
+        # changeset id -> (last sequence seen, elements), least
+        # recently seen first
+        self._pending = OrderedDict()
+        self._size = 0
+        self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        "Resume from the last checkpoint, if there is one"
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint, 'rb') as fd:
+                self.sequence, self._pending = pickle.load(fd)
+            self._size = sum(len(eles) for seq, eles
+                             in self._pending.values())
+
+    def _save_checkpoint(self):
+        """Save the last processed sequence and the changesets that
+        haven't been summarized yet"""
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'wb') as fd:
+            pickle.dump((self.sequence, self._pending), fd,
+                        pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.checkpoint)
+
+    def _emit(self, id):
+        "Summarize a pending changeset and write it out"
+        seq, eles = self._pending.pop(id)
+        self._size -= len(eles)
+        try:
+            summary = summarize(id, eles, self.remote)
+        except Exception:
+            logging.exception("Couldn't summarize changeset %s" % id)
+            return
+        summary['sequence'] = seq
+        self.output.write(json.dumps(summary) + '\n')
+
+    def flush(self, everything = False):
+        """Summarize changesets which have gone idle, plus the least
+        recently seen ones while too many elements are waiting"""
+        for id, (seq, eles) in self._pending.items():
+            if (everything or self.sequence - seq >= self.idle
+                or self._size > self.max_elements):
+                self._emit(id)
+            else:
+                break
+
+    def process(self, seq):
+        """Process one diff, summarize what's finished and save a
+        checkpoint"""
+        fd = open_file(sequence_path(self.directory, seq))
+        try:
+            for ele in parser.iterparseChange(fd):
+                id = ele['changeset']
+                last, eles = self._pending.pop(id, (seq, []))
+                eles.append(ele)
+                self._pending[id] = (seq, eles)
+                self._size += 1
+        finally:
+            fd.close()
+        self.sequence = seq
+        self.flush()
+        self._save_checkpoint()
+
+    def run(self, start = None, follow = False, interval = 60,
+            max_missing = 5):
+        """Process every diff after the checkpoint (or from start) up to
+        the latest one. When following, keep waiting for new diffs.
+        A diff which is still missing after max_missing checks, though
+        the state file says it's been published, is skipped when
+        following. Otherwise the run stops there, and False is
+        returned."""
+        if self.sequence is not None:
+            seq = self.sequence + 1
+        elif start is not None:
+            seq = start
+        else:
+            seq = read_state(self.directory)
+        missing = 0
+        while True:
+            latest = read_state(self.directory)
+            while (seq is not None and latest is not None and seq <= latest
+                   and os.path.exists(sequence_path(self.directory, seq))):
+                logging.debug("Processing replication sequence %d" % seq)
+                self.process(seq)
+                seq += 1
+                missing = 0
+            if seq is not None and latest is not None and seq <= latest:
+                # Published, but not here
+                missing += 1
+                if not follow:
+                    logging.warning("Replication sequence %d is missing, "
+                                    "stopping before it" % seq)
+                    return False
+                if missing >= max_missing:
+                    logging.warning("Replication sequence %d is still "
+                                    "missing after %d checks, skipping it"
+                                    % (seq, missing))
+                    seq += 1
+                    missing = 0
+                    continue
+                logging.info("Waiting for replication sequence %d" % seq)
+            if not follow:
+                return True
+            if seq is None:
+                seq = latest
+            time.sleep(interval)
+
+if __name__ == '__main__':
+    import argparse
+    argparser = argparse.ArgumentParser(
+        description="Summarize changesets from replication diffs")
+    argparser.add_argument('directory',
+                           help = 'The replication directory')
+    argparser.add_argument('-o', '--output', action='store',
+                           default='summaries.jsonl', dest='output',
+                           help = 'File to append JSON lines to')
+    argparser.add_argument('-c', '--checkpoint', action='store',
+                           default='replication.checkpoint',
+                           dest='checkpoint', help = 'Checkpoint file')
+    argparser.add_argument('-s', '--start', action='store', type=int,
+                           default=None, dest='start',
+                           help = 'Sequence to start from without a checkpoint')
+    argparser.add_argument('-f', '--follow', action='store_true',
+                           default=False, dest='follow',
+                           help = 'Keep waiting for new diffs')
+    argparser.add_argument('-i', '--interval', action='store', type=int,
+                           default=60, dest='interval',
+                           help = 'Seconds to wait between checks for diffs')
+    argparser.add_argument('-m', '--max-missing', action='store', type=int,
+                           default=5, dest='max_missing',
+                           help = 'Checks for a missing diff before skipping '
+                           'it when following')
+    argparser.add_argument('-r', '--remote', action='store_true',
+                           default=False, dest='remote',
+                           help = 'Look up parent ways and relations')
+    argparser.add_argument('--flush', action='store_true', default=False,
+                           dest='flush',
+                           help = 'Summarize every waiting changeset at the end')
+    args = argparser.parse_args()
+    with open(args.output, 'a') as output:
+        processor = Processor(args.directory, output, args.checkpoint,
+                              remote = args.remote)
+        complete = processor.run(args.start, args.follow, args.interval,
+                                 args.max_missing)
+        if args.flush:
+            processor.flush(everything = True)
+            processor._save_checkpoint()
+    sys.exit(0 if complete else 1)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Serves the web application from gevent, so requests waiting on the
+OSM API don't hold up any others. This needs gevent installed and has
+to patch the standard library before anything else is imported."""
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import logging
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+import elements
+import changemonger
+from app import app
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(
+        description="Serve changemonger asynchronously with gevent")
+    argparser.add_argument('-p', '--port', action='store', type=int,
+                           default=5000, dest='port',
+                           help = 'Set port to bind to')
+    argparser.add_argument('-i', '--ipaddr', action='store', dest='ipaddr',
+                           default='127.0.0.1', help = 'Set the IP to bind to')
+    argparser.add_argument('-c', '--connections', action='store', type=int,
+                           default=1000, dest='connections',
+                           help = 'Most requests to handle at once')
+    argparser.add_argument('-s', '--store', action='store', default=None,
+                           dest='store',
+                           help = 'Look parents up in a local element store')
+    argparser.add_argument('-F', '--feature-store', action='store',
+                           default=None, dest='feature_store',
+                           help = 'Read features from a feature store')
+    argparser.add_argument('-a', '--api', action='store', default=None,
+                           dest='api', help = 'The OSM API to use, such as '
+                           'http://api.openstreetmap.org/api/0.6')
+    argparser.add_argument('-r', '--rate', action='store', type=float,
+                           default=None, dest='rate',
+                           help = 'Most OSM API requests to make per second')
+    argparser.add_argument('-w', '--watch', action='store_true',
+                           default=False, dest='watch',
+                           help = 'Reload features when their files change')
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.store:
+        import localstore
+        elements.local_store = localstore.ElementStore(args.store)
+    if args.api or args.rate:
+        import osmapi
+        options = {}
+        if args.api:
+            options['endpoint'] = args.api
+        if args.rate:
+            options['rate'] = args.rate
+        osmapi.configure(**options)
+    if args.feature_store:
+        import featurestore
+        changemonger.db = featurestore.StoredFeatureDB(args.feature_store)
+    if args.watch:
+        changemonger.watch_features()
+    server = WSGIServer((args.ipaddr, args.port), app,
+                        spawn = Pool(args.connections))
+    server.serve_forever()
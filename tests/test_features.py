@@ -0,0 +1,123 @@
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks FeatureDB.reload() against loading afresh. A copy of the
+features directory has files edited, removed and added in turn, and
+after each step the reloaded database has to match a fresh one while
+the database it was reloaded from stays as it was."""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from features import FeatureDB
+from model import Element
+
+def describe(db):
+    """Describe everything a database works out from its files, by
+    name, so two databases can be compared"""
+    simple = [(f.name, list(f.types), list(f.tags),
+               [c.name for c in f.categories], f.named, f.plural,
+               f.precision, f.indefinite, f._prominence) for f in db.simple]
+    categories = [(c.name, [f.name for f in c.features], c.plural,
+                   c.precision, c.indefinite) for c in db.categories]
+    tag_index = sorted((tag, [f.name for f in db._tag_index.get(tag)])
+                       for tag in db._tag_index)
+    tagless = [f.name for f in db._tagless]
+    ranks = [(f.name, db._ranks[f]) for f in db.features]
+    matches = []
+    for f in db.simple:
+        ele = Element((f.types or ['node'])[0], {'id': 1})
+        ele.settags(dict((tag.split('=', 1) + [''])[:2] for tag in f.tags))
+        ele._tags = tuple(f.tags)
+        matches.append([m.name for m in db.matchAllSolo(ele)])
+    return {'simple': simple, 'categories': categories,
+            'tag index': tag_index, 'tagless': tagless, 'ranks': ranks,
+            'matches': matches}
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmp, 'features')
+        shutil.copytree(os.path.join(os.path.dirname(__file__), os.pardir,
+                                     'features'), self.directory)
+        self.simple = os.path.join(self.directory, 'simple')
+        self.files = sorted(os.path.join(self.simple, f)
+                            for f in os.listdir(self.simple)
+                            if f.endswith('.yaml') or f.endswith('.yml'))
+        # Modification times only have to differ from the last step's
+        self.stamp = time.time()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def touch(self, fname):
+        self.stamp += 10
+        os.utime(fname, (self.stamp, self.stamp))
+
+    def append(self, fname, text):
+        with open(fname, 'a') as fd:
+            fd.write(text)
+        self.touch(fname)
+
+    def edit(self, fname, old, new):
+        with open(fname) as fd:
+            text = fd.read()
+        with open(fname, 'w') as fd:
+            fd.write(text.replace(old, new, 1))
+        self.touch(fname)
+
+    def test_reload(self):
+        steps = [
+            ('add a feature to an existing and a new category',
+             lambda: self.append(self.files[0],
+                                 "\n- name: reload check feature\n"
+                                 "  categories:\n    - shop\n"
+                                 "    - reload check category\n"
+                                 "  tags: reload=check\n")),
+            ('rename a feature',
+             lambda: self.edit(self.files[1], '- name: ', '- name: renamed ')),
+            ('remove a file', lambda: os.remove(self.files[2])),
+            ('add a file',
+             lambda: self.append(os.path.join(self.simple,
+                                              'reload-check.yaml'),
+                                 "- name: reload check added\n"
+                                 "  categories:\n"
+                                 "    - reload check category\n"
+                                 "  tags: reload=added\n")),
+            ('remove the new category again',
+             lambda: os.remove(self.files[0])),
+            ]
+        db = FeatureDB(self.directory)
+        for name, step in steps:
+            before = describe(db)
+            step()
+            self.assertTrue(db.changed(), "%s: no change noticed" % name)
+            reloaded = db.reload()
+            fresh = FeatureDB(self.directory, snapshot = False)
+            self.assertEqual(describe(db), before,
+                             "%s: the old database changed" % name)
+            got, expected = describe(reloaded), describe(fresh)
+            for key in sorted(expected):
+                self.assertEqual(got[key], expected[key],
+                                 "%s: %s differs from a fresh load"
+                                 % (name, key))
+            db = reloaded
+
+if __name__ == '__main__':
+    unittest.main()
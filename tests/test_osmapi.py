@@ -0,0 +1,163 @@
+##  Changemonger: An OpenStreetMap change analyzer
+##  Copyright (C) 2012 Serge Wroclawski
+##
+##  This program is free software: you can redistribute it and/or modify
+##  it under the terms of the GNU Affero General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU Affero General Public License for more details.
+##
+##  You should have received a copy of the GNU Affero General Public License
+##  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reads responses from a local server the way they come from the OSM
+API: with a length, chunked or compressed"""
+
+import gzip
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
+
+import osmapi
+import metrics
+import cache
+
+body = (u'<osm>' + u'<node id="1" lat="0" lon="0"/>' * 3000 +
+        u'<node id="2" lat="0" lon="0"><tag k="name" v="caf\xe9"/></node>'
+        u'</osm>').encode('utf-8')
+
+def _gzipped(data):
+    buf = StringIO()
+    fd = gzip.GzipFile(fileobj = buf, mode = 'wb')
+    fd.write(data)
+    fd.close()
+    return buf.getvalue()
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Serves body at /length, /chunked and /gzip, keeping connections open"
+    protocol_version = 'HTTP/1.1'
+    # Idle kept alive connections are let go of quickly
+    timeout = 0.5
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        if self.path.endswith('/chunked'):
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(body), 5000):
+                chunk = body[i:i + 5000]
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write('0\r\n\r\n')
+            return
+        data = body
+        if self.path.endswith('/gzip'):
+            data = _gzipped(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop kept alive connections when they're done
+        pass
+
+class GetTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.directory = tempfile.mkdtemp()
+        self.saved = osmapi.client, osmapi.cache
+        osmapi.cache = cache.Cache(self.directory)
+        # A short timeout, so a read waiting on a kept alive
+        # connection fails quickly instead of hanging the test
+        osmapi.configure(endpoint = 'http://127.0.0.1:%d/api/0.6'
+                         % self.server.server_port, timeout = 5)
+
+    def tearDown(self):
+        osmapi.client.session.poolmanager.clear()
+        osmapi.client, osmapi.cache = self.saved
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def _bytes(self):
+        return metrics.api_bytes._values.get((), 0)
+
+    def check(self, path, wire):
+        before = self._bytes()
+        url = osmapi.client.url(path)
+        self.assertEqual(osmapi._get(url), body.decode('utf-8'))
+        self.assertEqual(self._bytes() - before, wire)
+        # And again from the cache
+        self.assertEqual(osmapi._get(url), body.decode('utf-8'))
+
+    def test_length(self):
+        self.check('/length', len(body))
+        # The connection is reused for the next request
+        self.check('/length/again', len(body))
+
+    def test_chunked(self):
+        self.check('/chunked', len(body))
+
+    def test_gzip(self):
+        self.check('/gzip', len(_gzipped(body)))
+
+    def test_stream(self):
+        fd = osmapi.getChangeStream(1)
+        self.assertEqual(fd.read(10) + fd.read(), body)
+
+class SlotTest(GetTest):
+    "Connection slots are held until responses have been read"
+    def setUp(self):
+        GetTest.setUp(self)
+        osmapi.configure(endpoint = 'http://127.0.0.1:%d/api/0.6'
+                         % self.server.server_port, timeout = 5,
+                         pool_size = 2)
+
+    def free(self):
+        "How many slots are free"
+        slots = osmapi.client._slots
+        n = 0
+        while slots.acquire(False):
+            n += 1
+        for i in range(n):
+            slots.release()
+        return n
+
+    def test_held_while_streaming(self):
+        fd = osmapi.getChangeStream(1)
+        self.assertEqual(self.free(), 1)
+        fd.read(10)
+        self.assertEqual(self.free(), 1)
+        fd.read()
+        self.assertEqual(self.free(), 2)
+
+    def test_closed(self):
+        fd = osmapi.getChangeStream(1)
+        fd.read(10)
+        fd.close()
+        self.assertEqual(self.free(), 2)
+
+    def test_get(self):
+        osmapi._get(osmapi.client.url('/chunked'))
+        self.assertEqual(self.free(), 2)
+
+if __name__ == '__main__':
+    unittest.main()